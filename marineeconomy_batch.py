@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+This script runs the local marine economy analysis for many study areas in one job. The study areas are listed in a manifest file, each with its own list of zip codes and years. The script will go through the following processes:
+
+
+*   Reading the manifest of study areas
+*   Fetching every zip code and year needed by any study area once, even when study areas overlap
+*   Cleaning the fetched data once
+*   Creating the Total Economy, Marine Economy and analysis tables of each study area, in parallel processes
+*   Writing one output per study area, plus a summary of all of them
+
+The manifest is either a CSV file with one row per zip code of a study area:
+
+    StudyArea,Zipcode,Year
+    Duluth,55807,2012-2016
+    Duluth,55811,2012-2016
+    Superior,54880,2016
+
+or a YAML file (this needs the PyYAML package):
+
+    Duluth:
+      zips: ['55807', '55811']
+      years: 2012-2016
+    Superior:
+      zips: ['54880']
+      years: [2015, 2016]
+
+Example:
+
+    python -m marineeconomy_batch study_areas.csv --out-dir C:\\Data\\Out --processes 4
+"""
+
+import pandas as pd
+import argparse
+import datetime
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import marineeconomy_zbp_retrieval_analysis as zbp
+
+
+def read_manifest(path):
+    """Read a CSV or YAML manifest and return a dict of study area name -> (list of zip codes, list of years)."""
+    areas={}
+    if path.lower().endswith(('.yaml', '.yml')):
+        import yaml
+        with open(path) as f:
+            for name, area in yaml.safe_load(f).items():
+                #The years are a single year or range, or a list of years and ranges
+                years=area['years'] if isinstance(area['years'], list) else str(area['years'])
+                areas[str(name)]=([str(zipcode) for zipcode in area['zips']], zbp.parse_years(years))
+        return areas
+    #Read every column as text so zip codes keep their leading zeros
+    manifest=pd.read_csv(path, dtype=str)
+    for name, rows in manifest.groupby('StudyArea', sort=False):
+        zips=list(dict.fromkeys(rows['Zipcode'].str.strip()))
+        years=sorted(set(zbp.parse_years(list(rows['Year'].str.strip()))))
+        areas[name]=(zips, years)
+    return areas
+
+
+def fetch_shared(areas, cache=None, **kwargs):
+    """Fetch every zip code and year used by any study area once, and return the cleaned data of all of them.
+
+    The zip codes are fetched year by year, each year with the union of the zip codes of the study
+    areas that use it. Any extra keyword arguments are passed on to fetch_all_zips.
+    """
+    zips_by_year={}
+    for zips, years in areas.values():
+        for year in years:
+            zips_by_year.setdefault(year, {}).update(dict.fromkeys(zips))
+    print('Fetching ' + str(sum(len(zips) for zips in zips_by_year.values())) + ' zip code and year pairs for '
+          + str(len(areas)) + ' study areas')
+    df_AllZips=pd.concat([zbp.fetch(list(zips), [year], cache=cache, **kwargs) for year, zips in sorted(zips_by_year.items())]
+                         , ignore_index=True)
+    return zbp.clean(df_AllZips)
+
+
+def run_area(name, TotalEconomy_df, out_file, formats):
+    """Create and write the tables of one study area from its cleaned rows, and return its summary rows.
+
+    This runs in a worker process, so it only takes and returns picklable values.
+    """
+    TotalEcon, Marine_df=zbp.enrich(TotalEconomy_df)
+    tables=zbp.aggregate(TotalEcon)
+    tables['TotalEconomy_Data']=TotalEcon
+    tables['MarineSectors_Data']=Marine_df
+    zbp.write(tables, out_file, formats)
+
+    #The study area totals of Table 1, one row per year
+    summary=tables['Table1_Analysis']
+    summary=summary[summary['Zipcode']=='XXXXX'].drop(columns=['Zipcode','GeoName'])
+    return summary.assign(**{'Study Area':name, 'Zip Codes':TotalEcon['Zipcode'].nunique()})
+
+
+def run_batch(areas, out_dir, formats=zbp.Output_Formats, processes=None, cache=None, **kwargs):
+    """Run the analysis for every study area in `areas` and write one output per area plus a summary CSV.
+
+    `areas` is a dict of study area name -> (zip codes, years), such as the one returned by
+    read_manifest. The shared data is fetched and cleaned once, then the study areas are processed
+    by a pool of `processes` worker processes (one per CPU by default). Returns the summary table.
+    Any extra keyword arguments are passed on to fetch_all_zips.
+    """
+    TotalEconomy_df=fetch_shared(areas, cache=cache, **kwargs)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures=[]
+        for name, (zips, years) in areas.items():
+            rows=TotalEconomy_df[TotalEconomy_df['Zipcode'].isin(zips) & TotalEconomy_df['Year'].isin(years)]
+            #Study area names become file names, so characters that are not allowed in file names are replaced
+            out_file=os.path.join(out_dir, re.sub(r'[^\w\- ]', '_', name) + zbp.OutFile_BaseName)
+            futures.append(pool.submit(run_area, name, rows, out_file, formats))
+        summaries=[future.result() for future in futures]
+
+    summary=pd.concat(summaries, ignore_index=True)
+    summary=summary[['Study Area','Year','Zip Codes'] + [column for column in summary.columns if column not in ('Study Area','Year','Zip Codes')]]
+    summary.to_csv(os.path.join(out_dir, 'BatchSummary.csv'), index=False)
+    return summary
+
+
+def main(argv=None):
+    """Command line entry point of the batch runner."""
+    parser=argparse.ArgumentParser(description='Run the local marine economy analysis for every study area in a manifest.')
+    parser.add_argument('manifest', help='CSV (StudyArea, Zipcode, Year columns) or YAML manifest of study areas')
+    parser.add_argument('-o', '--out-dir', default=zbp.OutFile_Loc, help='folder where the outputs and the summary are saved')
+    parser.add_argument('-f', '--formats', nargs='+', default=zbp.Output_Formats, choices=sorted(zbp.OUTPUT_WRITERS), help='output formats to write')
+    parser.add_argument('--processes', type=int, default=None, help='number of study areas processed at the same time (default: one per CPU)')
+    parser.add_argument('--cache-dir', help='folder of cached Census API responses (default: ' + str(zbp.Cache_Dir) + ' in the output folder)')
+    parser.add_argument('--no-cache', action='store_true', help='always download from the Census API')
+    parser.add_argument('--census-url', default=zbp.Census_BaseURL, help='base url of the Census API')
+    parser.add_argument('--workers', type=int, default=zbp.Fetch_MaxWorkers, help='number of API requests sent at the same time')
+    parser.add_argument('--zips-per-request', type=int, default=zbp.Fetch_ZipsPerRequest, help='number of zip codes packed into one API request')
+    args=parser.parse_args(argv)
+
+    StartTime = datetime.datetime.now()
+    print('Starting at ' + StartTime.strftime("%I:%M:%S %p"))
+
+    areas=read_manifest(args.manifest)
+    CacheDir=args.cache_dir if args.cache_dir is not None else zbp.output_folder(args.out_dir, zbp.Cache_Dir)
+    ApiCache=None if args.no_cache or CacheDir is None else zbp.ZBPCache(CacheDir, max_bytes=zbp.Cache_MaxMB * 1024 * 1024, base_url=args.census_url)
+    run_batch(areas, args.out_dir, formats=args.formats, processes=args.processes, cache=ApiCache,
+              base_url=args.census_url, max_workers=args.workers, zips_per_request=args.zips_per_request)
+
+    print('Summary written to ' + os.path.join(args.out_dir, 'BatchSummary.csv'))
+    if ApiCache is not None:
+        print(ApiCache.summary())
+    EndTime = datetime.datetime.now()
+    print('Ended at ' + EndTime.strftime("%I:%M:%S %p"))
+
+
+if __name__ == '__main__':
+    main()
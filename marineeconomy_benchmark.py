@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+This script times the marine economy pipeline offline, on synthetic data served by the stand-in Census API in marineeconomy_synthetic. For each scale (a number of zip codes), it runs and times each stage:
+
+
+*   Fetching the zip codes from the stand-in API
+*   Cleaning the data
+*   Creating the Total Economy and Marine Economy tables and the analysis tables
+*   Writing the Excel file
+
+Each scale runs in a fresh process, so the peak memory of one scale isn't carried over to the next. The pipeline is run once to warm up (imports, connections, file system caches) and then several times, and each stage keeps its median and fastest time. The results are appended to a JSON lines file, one line per scale, labelled with the version of the code (git describe), and each run is compared with the last results of a different version so slowdowns in any stage show up.
+
+Example:
+
+    python -m marineeconomy_benchmark --scales 1 10 100 1000 10000
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import marineeconomy_synthetic as synthetic
+import marineeconomy_zbp_retrieval_analysis as zbp
+
+#Number of zip codes of each benchmark run
+Benchmark_Scales=[1, 10, 100, 1000]
+
+#Year of the synthetic data
+Benchmark_Year='2016'
+
+#Number of timed runs of each scale, after one warm-up run that isn't timed
+Benchmark_Repeats=5
+
+#Stages whose fastest run is slower than that of the previous version by more than this ratio are flagged as regressions.
+#Stages that take less than Benchmark_MinSeconds are too short to time reliably and are never flagged
+Benchmark_RegressionRatio=1.2
+Benchmark_MinSeconds=0.05
+
+
+def code_version():
+    """Return the git describe of the code being benchmarked, or 'unknown' outside of a git checkout."""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty', '--tags'], cwd=os.path.dirname(os.path.abspath(__file__))
+                              , capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def benchmark_scale(zip_count, base_url, out_dir, **kwargs):
+    """Run the pipeline for `zip_count` synthetic zip codes and return the time, rows and peak memory of each stage.
+
+    Returns a dict of stage name -> record, with the 'fetch', 'clean', 'aggregate' and
+    'write excel' stages first, followed by the totals of the finer stages recorded by the pipeline
+    functions. The messages printed by the pipeline are discarded. Any extra keyword arguments are
+    passed on to fetch_all_zips.
+    """
+    report=zbp.RunReport()
+    timings=zbp.RunReport()
+    zips=synthetic.synthetic_zips(zip_count)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with timings.stage('fetch', rows_in=zip_count) as result:
+            df_AllZips=zbp.fetch(zips, [Benchmark_Year], base_url=base_url, report=report, **kwargs)
+            result['rows_out']=len(df_AllZips)
+        with timings.stage('clean', rows_in=len(df_AllZips)) as result:
+            TotalEconomy_df=zbp.clean(df_AllZips, report=report)
+            result['rows_out']=len(TotalEconomy_df)
+        with timings.stage('aggregate', rows_in=len(TotalEconomy_df)) as result:
+            TotalEcon, Marine_df=zbp.enrich(TotalEconomy_df, report=report)
+            tables=zbp.aggregate(TotalEcon, report=report)
+            tables['TotalEconomy_Data']=TotalEcon
+            tables['MarineSectors_Data']=Marine_df
+            TableRows=sum(len(table) for table in tables.values())
+            result['rows_out']=TableRows
+        with timings.stage('write excel', rows_in=TableRows) as result:
+            zbp.write_excel(tables, os.path.join(out_dir, str(zip_count) + zbp.OutFile_BaseName), report=report)
+            result['rows_out']=TableRows
+
+    stages={record['stage']: record for record in timings.stages}
+    #The finer stages added up by kind. The API requests overlap, so they add up to more than the fetch
+    for stage, total in report.to_dict()['totals'].items():
+        stages[stage + ' (total)']={'stage':stage, 'seconds':total['seconds'], 'count':total['count']}
+    return stages
+
+
+def benchmark_repeats(zip_count, base_url, out_dir, repeats=Benchmark_Repeats, **kwargs):
+    """Run benchmark_scale once to warm up and then `repeats` times, and return the stages of the last run with the times of all of them.
+
+    The 'seconds' of each stage is the median of the timed runs, and 'min_seconds' the fastest.
+    """
+    benchmark_scale(zip_count, base_url, out_dir, **kwargs)
+    runs=[benchmark_scale(zip_count, base_url, out_dir, **kwargs) for _ in range(max(repeats, 1))]
+    stages=runs[-1]
+    for stage, record in stages.items():
+        seconds=[run[stage]['seconds'] for run in runs if stage in run]
+        record['seconds']=float(np.median(seconds))
+        record['min_seconds']=min(seconds)
+        record['repeats']=len(seconds)
+    return stages
+
+
+def run_benchmarks(scales, results_file, base_url=None, label=None, repeats=Benchmark_Repeats, **kwargs):
+    """Benchmark each scale in its own process, append the results to `results_file` and return them.
+
+    The synthetic data is served in this process unless `base_url` points to another server. Any
+    extra keyword arguments are passed on to fetch_all_zips.
+    """
+    server=None
+    if base_url is None:
+        server, base_url=synthetic.serve()
+    environment={'version':label or code_version()
+                ,'timestamp':datetime.datetime.now().isoformat(timespec='seconds')
+                ,'python':platform.python_version()
+                ,'pandas':pd.__version__
+                ,'numpy':np.__version__
+                ,'platform':platform.platform()}
+    results=[]
+    try:
+        with tempfile.TemporaryDirectory() as out_dir:
+            for zip_count in scales:
+                print('Benchmarking ' + str(zip_count) + ' zip codes')
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    stages=pool.submit(benchmark_repeats, zip_count, base_url, out_dir, repeats, **kwargs).result()
+                results.append(dict(environment, zips=zip_count, stages=stages))
+                with open(results_file, 'a') as f:
+                    f.write(json.dumps(results[-1]) + '\n')
+    finally:
+        if server is not None:
+            server.shutdown()
+    return results
+
+
+def compare(results, results_file, ratio=Benchmark_RegressionRatio):
+    """Print the time of each stage next to the last results of a different version in `results_file`.
+
+    The fastest runs are compared, since the slower runs mostly measure noise from the rest of the
+    machine, and stages more than `ratio` times slower than before are marked as regressions.
+    Returns the list of (zips, stage, previous seconds, seconds) regressions.
+    """
+    version=results[0]['version']
+    previous={}
+    with open(results_file) as f:
+        for line in f:
+            record=json.loads(line)
+            if record['version'] != version:
+                previous[record['zips']]=record
+    regressions=[]
+    for result in results:
+        before=previous.get(result['zips'])
+        print(str(result['zips']) + ' zip codes' + ('' if before is None else ' (compared with ' + before['version'] + ')'))
+        for stage, record in result['stages'].items():
+            #Results saved before the runs were repeated only have the time of their single run
+            fastest=record.get('min_seconds', record['seconds'])
+            line='  ' + stage.ljust(40) + str(round(record['seconds'], 3)).rjust(9) + ' s (fastest ' + str(round(fastest, 3)) + ' s)'
+            if record.get('peak_mb') is not None:
+                line += ', peak memory ' + str(round(record['peak_mb'])) + ' MB'
+            previous_fastest=before['stages'][stage].get('min_seconds', before['stages'][stage]['seconds']) if before is not None and stage in before['stages'] else 0
+            if previous_fastest > 0:
+                change=fastest / previous_fastest
+                line += ', ' + str(round(change, 2)) + 'x'
+                if change > ratio and fastest >= Benchmark_MinSeconds:
+                    line += ' REGRESSION'
+                    regressions.append((result['zips'], stage, previous_fastest, fastest))
+            print(line)
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point of the benchmark."""
+    parser=argparse.ArgumentParser(description='Time each stage of the marine economy pipeline on synthetic data.')
+    parser.add_argument('--scales', nargs='+', type=int, default=Benchmark_Scales, help='numbers of zip codes to benchmark')
+    parser.add_argument('--results', default='benchmark_results.jsonl', help='JSON lines file the results are appended to')
+    parser.add_argument('--repeats', type=int, default=Benchmark_Repeats, help='number of timed runs of each scale, after a warm-up run')
+    parser.add_argument('--label', help='version label of the results (default: git describe)')
+    parser.add_argument('--census-url', help='base url of an already running stand-in server (default: start one)')
+    parser.add_argument('--workers', type=int, default=zbp.Fetch_MaxWorkers, help='number of API requests sent at the same time')
+    parser.add_argument('--zips-per-request', type=int, default=zbp.Fetch_ZipsPerRequest, help='number of zip codes packed into one API request')
+    args=parser.parse_args(argv)
+
+    results=run_benchmarks(args.scales, args.results, base_url=args.census_url, label=args.label, repeats=args.repeats,
+                           max_workers=args.workers, zips_per_request=args.zips_per_request)
+    print('Results appended to ' + args.results)
+    regressions=compare(results, args.results)
+    if regressions:
+        raise SystemExit(str(len(regressions)) + ' stages are slower than before')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+This script checks the marine economy pipeline offline, against the synthetic data served by the stand-in Census API in marineeconomy_synthetic. Each check runs the pipeline in a temporary folder and compares its results with what they should be:
+
+
+*   incremental: a run that reuses the saved results of some of the zip codes gives the same tables as a run that processes them all
+*   retries: requests answered with rate limiting (HTTP 429) or server errors are retried, waiting longer before each retry, and give the same data as requests that succeed at once
+*   splitting: requests for too many zip codes are split in half until they succeed, and give the same data as requests that succeed at once
+*   service: the HTTP service answers with the same tables as run(), computes the tables of a study area asked for by several requests at the same time only once, shares the zip code downloads of overlapping study areas, and refuses bad requests with HTTP 400
+
+Example:
+
+    python -m marineeconomy_check
+    python -m marineeconomy_check incremental
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import marineeconomy_service as service
+import marineeconomy_synthetic as synthetic
+import marineeconomy_zbp_retrieval_analysis as zbp
+
+
+class CheckFailed(Exception):
+    """Raised by a check when the pipeline doesn't give the expected result."""
+
+
+def plain(df):
+    """Return `df` with a fresh index and its categorical columns as plain values, to compare tables by their values and order."""
+    return df.reset_index(drop=True).astype({column: object for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)})
+
+
+def check_incremental(base_url):
+    """Check that reusing saved zip code results gives the same tables, in the same order, as processing every zip code."""
+    #The zip codes are out of order on purpose, like zip_list, and the first run only processes some of them
+    zips=['10005','10001','10009','10003']
+    years=['2016','2017']
+    with tempfile.TemporaryDirectory() as partials_dir, contextlib.redirect_stdout(io.StringIO()):
+        partials=zbp.PartialStore(partials_dir, source=base_url)
+        zbp.run(zips[2:], years, partials=partials, base_url=base_url)
+        incremental=zbp.run(zips, years, partials=partials, base_url=base_url)
+        full=zbp.run(zips, years, base_url=base_url)
+    if list(incremental) != list(full):
+        raise CheckFailed('the incremental run made the tables ' + ', '.join(incremental) + ' instead of ' + ', '.join(full))
+    for name in full:
+        try:
+            pd.testing.assert_frame_equal(plain(incremental[name]), plain(full[name]))
+        except AssertionError as err:
+            raise CheckFailed(name + ' differs from the full run: ' + str(err).splitlines()[0])
+
+
+def fetch_quietly(zips, years, base_url, **kwargs):
+    """Fetch `zips` like fetch_all_zips, one request at a time and without its messages."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return zbp.fetch_all_zips(zips, years, max_workers=1, base_url=base_url, **kwargs)
+
+
+def check_retries(base_url):
+    """Check that rate limited and failed requests are retried with a growing wait, and that they give up after `retries`."""
+    zips=synthetic.synthetic_zips(3)
+    expected=fetch_quietly(zips, ['2016'], base_url)
+    for status in [429, 503]:
+        server, faulty_url=synthetic.serve(fail_first=2, fail_status=status)
+        try:
+            start=time.perf_counter()
+            fetched=fetch_quietly(zips, ['2016'], faulty_url, zips_per_request=3, retries=2, backoff=0.1)
+            seconds=time.perf_counter() - start
+        finally:
+            server.shutdown()
+        if [answer for _, answer in server.requests] != [status, status, 200]:
+            raise CheckFailed('HTTP ' + str(status) + ' was answered with the requests ' + str(server.requests) + ' instead of two retries')
+        #The waits are 0.1 and then 0.2 seconds
+        if seconds < 0.3:
+            raise CheckFailed('the retries after HTTP ' + str(status) + ' only waited ' + str(round(seconds, 2)) + ' seconds')
+        if not fetched.equals(expected):
+            raise CheckFailed('the data fetched after HTTP ' + str(status) + ' differs from the data fetched at once')
+
+    #With fewer retries than failures the error is raised
+    server, faulty_url=synthetic.serve(fail_first=2)
+    try:
+        fetch_quietly(zips, ['2016'], faulty_url, zips_per_request=3, retries=1, backoff=0)
+    except urllib.error.HTTPError:
+        pass
+    else:
+        raise CheckFailed('the request succeeded although it failed more times than it was retried')
+    finally:
+        server.shutdown()
+
+
+def check_splitting(base_url):
+    """Check that requests for too many zip codes are split in half down to requests the server accepts."""
+    zips=synthetic.synthetic_zips(8)
+    expected=fetch_quietly(zips, ['2016'], base_url)
+    server, faulty_url=synthetic.serve(max_zips=2)
+    try:
+        fetched=fetch_quietly(zips, ['2016'], faulty_url, zips_per_request=8, retries=0)
+    finally:
+        server.shutdown()
+    if server.requests != [(8, 414), (4, 414), (2, 200), (2, 200), (4, 414), (2, 200), (2, 200)]:
+        raise CheckFailed('the request for 8 zip codes was split into the requests ' + str(server.requests))
+    if not fetched.equals(expected):
+        raise CheckFailed('the data fetched in halves differs from the data fetched at once')
+
+
+def post_json(url, body):
+    """POST `body` (JSON, or bytes sent as they are) to `url` and return the HTTP status and the decoded JSON answer."""
+    data=body if isinstance(body, bytes) else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method='POST')) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as err:
+        return err.code, json.load(err)
+
+
+def post_together(url, bodies):
+    """POST every body in `bodies` at the same time from its own thread and return their (status, answer) in the same order."""
+    barrier=threading.Barrier(len(bodies))
+
+    def post(body):
+        barrier.wait()
+        return post_json(url, body)
+    with ThreadPoolExecutor(max_workers=len(bodies)) as pool:
+        return list(pool.map(post, bodies))
+
+
+def check_service(base_url):
+    """Check the tables, the result and zip code caches, and the request checks of the HTTP service."""
+    #Every request to this stand-in fails once and is retried after a short wait, so the downloads of requests sent at the
+    #same time overlap
+    census, slow_url=synthetic.serve(fail_first=1)
+    pipeline=service.MarineEconomyService(backing=None, base_url=slow_url, backoff=0.2)
+    server, url=service.serve(pipeline)
+    try:
+        #The service logs every request on stderr
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            area={'zips':['10001','10002','10003'], 'years':'2016'}
+            answers=post_together(url + 'analysis', [area] * 4)
+            if pipeline.status()['result_misses'] != 1:
+                raise CheckFailed('4 requests for the same study area were computed ' + str(pipeline.status()['result_misses']) + ' times')
+
+            #Two study areas sharing 10004 and 10005, asked for at the same time
+            post_together(url + 'analysis', [{'zips':['10004','10005','10006'], 'years':'2016'}, {'zips':['10004','10005','10007'], 'years':'2016'}])
+            if pipeline.status()['zip_requests_shared'] == 0:
+                raise CheckFailed('the overlapping study areas downloaded their shared zip codes twice')
+
+            expected=zbp.run(area['zips'], [area['years']], base_url=base_url, names=service.Service_Tables)
+            expected={name: json.loads(json.dumps(service.table_records(table))) for name, table in expected.items()}
+            for status, answer in answers:
+                if status != 200 or answer['tables'] != expected:
+                    raise CheckFailed('the service answered HTTP ' + str(status) + ' with tables that differ from run()')
+
+            bad=[b'not json', {'zips':'1234'}, {'zips':['10001'], 'years':'2016-2012'}, {'zips':['10001'], 'years':2016.5}
+                ,{'zips':['10001'], 'tables':['Table0']}, {'zips':['10001'], 'uncertainty':{'draws':'x'}}
+                ,{'zips':['10001'], 'uncertainty':{'draws':service.Service_MaxDraws + 1}}
+                ,{'zips':synthetic.synthetic_zips(service.Service_MaxZips + 1)}]
+            for body in bad:
+                status, answer=post_json(url + 'analysis', body)
+                if status != 400:
+                    raise CheckFailed('the bad request ' + str(body)[:60] + ' was answered with HTTP ' + str(status) + ': ' + str(answer))
+    finally:
+        server.shutdown()
+        census.shutdown()
+
+
+#The check functions by name, each called with the base url of the stand-in server
+CHECKS={'incremental':check_incremental, 'retries':check_retries, 'splitting':check_splitting, 'service':check_service}
+
+def run_checks(names=None, base_url=None):
+    """Run the checks in `names` (all of them by default), print the result of each and return the names of those that failed.
+
+    The synthetic data is served in this process unless `base_url` points to another server.
+    """
+    server=None
+    if base_url is None:
+        server, base_url=synthetic.serve()
+    failed=[]
+    try:
+        for name in names or list(CHECKS):
+            try:
+                CHECKS[name](base_url)
+                print('  ' + name.ljust(20) + 'ok')
+            except CheckFailed as err:
+                print('  ' + name.ljust(20) + 'FAILED: ' + str(err))
+                failed.append(name)
+    finally:
+        if server is not None:
+            server.shutdown()
+    return failed
+
+
+def main(argv=None):
+    """Command line entry point of the checks."""
+    parser=argparse.ArgumentParser(description='Check the marine economy pipeline offline, on synthetic data.')
+    parser.add_argument('checks', nargs='*', help='checks to run, out of ' + ', '.join(CHECKS) + ' (default: all of them)')
+    parser.add_argument('--census-url', help='base url of an already running stand-in server (default: start one)')
+    args=parser.parse_args(argv)
+    unknown=[name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error('unknown checks: ' + ', '.join(unknown))
+
+    failed=run_checks(args.checks, base_url=args.census_url)
+    if failed:
+        raise SystemExit(str(len(failed)) + ' checks failed: ' + ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
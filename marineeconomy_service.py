@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+This script runs the local marine economy analysis as a small HTTP service, so a web portal can ask for the tables of a study area without starting Python and downloading every zip code again for each request. The service:
+
+
+*   Loads the libraries, the midpoints and the marine sector crosswalks once, when it starts
+*   Keeps the Census API responses of the most recently used zip codes in memory, optionally backed by the cache folder on disk
+*   Downloads a zip code only once when several requests need it at the same time, the other requests wait for that download
+*   Keeps the tables of the most recent study areas in memory, and computes them only once when the same study area is asked for by several requests at the same time
+*   Returns the analysis tables as JSON, or the Excel workbook
+
+A study area is requested with a POST of a JSON body to /analysis:
+
+    {"zips": ["54880", "55807"], "years": "2016", "format": "json"}
+
+or with a GET of /analysis?zips=54880,55807&years=2016&format=xlsx. The optional "tables" lists the tables to create and return (the five analysis tables as JSON, and every table in the workbook, by default), and "uncertainty" (true, or a dict with draws, level and max_employees) adds the employment ranges of add_uncertainty. GET /status returns the cache counts.
+
+Example, with the Census API replaced by the synthetic stand-in:
+
+    python -m marineeconomy_synthetic --port 8765
+    python -m marineeconomy_service --port 8080 --census-url http://127.0.0.1:8765/data/
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import os
+import re
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import Future
+
+import marineeconomy_zbp_retrieval_analysis as zbp
+
+#Address the service listens on
+Service_Host='127.0.0.1'
+Service_Port=8080
+
+#Number of zip code and year responses, and of study area results, kept in memory. The least recently used are dropped first
+Service_CacheZips=2000
+Service_CacheResults=64
+
+#Largest number of zip codes and of simulated draws of a request. Larger requests are refused, since their tables and
+#simulations can take more memory than the service has
+Service_MaxZips=1000
+Service_MaxDraws=10000
+
+#Tables returned as JSON when a request doesn't list them
+Service_Tables=['Table1_Analysis','Table2_Analysis','Table3_Analysis','Table4_Analysis','Table5_Analysis']
+
+
+class MemoryCache:
+    """In-memory LRU cache of Census API responses, one per year and zip code, with the get/put/evict methods of ZBPCache.
+
+    Responses missing from memory are looked up in `backing` (a ZBPCache) when one is given, and
+    responses put in the cache are saved to it too. fetch() downloads the zip codes missing from the
+    cache, and waits for the ones another thread is already downloading instead of requesting them
+    again.
+    """
+
+    def __init__(self, max_entries=Service_CacheZips, backing=None):
+        self.max_entries=max_entries
+        self.backing=backing
+        self.hits=0
+        self.misses=0
+        self.coalesced=0
+        self._rows=collections.OrderedDict()
+        self._inflight={}
+        self._lock=threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, year, zipcode):
+        """Return the cached response rows of a year and zip code, or None when they aren't cached."""
+        key=(str(year), str(zipcode))
+        with self._lock:
+            rows=self._rows.get(key)
+            if rows is not None:
+                self._rows.move_to_end(key)
+                self.hits+=1
+                return rows
+        rows=self.backing.get(year, zipcode) if self.backing is not None else None
+        with self._lock:
+            if rows is None:
+                self.misses+=1
+            else:
+                self.hits+=1
+                self._rows[key]=rows
+        return rows
+
+    def put(self, year, zipcode, rows):
+        """Cache the response rows of a year and zip code, and hand them to the threads waiting for them."""
+        key=(str(year), str(zipcode))
+        with self._lock:
+            self._rows[key]=rows
+            self._rows.move_to_end(key)
+            future=self._inflight.pop(key, None)
+        if future is not None:
+            future.set_result(True)
+        if self.backing is not None:
+            self.backing.put(year, zipcode, rows)
+
+    def evict(self):
+        """Drop the least recently used responses past `max_entries`. Returns the number dropped."""
+        removed=0
+        with self._lock:
+            while len(self._rows) > self.max_entries:
+                self._rows.popitem(last=False)
+                removed+=1
+        if self.backing is not None:
+            self.backing.evict()
+        return removed
+
+    def fetch(self, zips, years, **kwargs):
+        """Make sure the responses of every zip code and year are cached, downloading each one only once across threads.
+
+        The zip codes no other thread is downloading are fetched by this thread, then it waits for
+        the others. When the thread downloading a zip code fails, the waiting threads download it
+        themselves. Any extra keyword arguments are passed on to fetch_all_zips.
+        """
+        years=zbp.parse_years(years)
+        while True:
+            mine, waits=[], []
+            with self._lock:
+                for year in years:
+                    for zipcode in zips:
+                        key=(year, zipcode)
+                        if key in self._rows:
+                            continue
+                        if key in self._inflight:
+                            waits.append(self._inflight[key])
+                            self.coalesced+=1
+                        else:
+                            self._inflight[key]=Future()
+                            mine.append(key)
+            #Read the responses of this thread's zip codes from the backing cache or the Census API. Each response is put into this
+            #cache as it arrives, which wakes up the threads waiting for it
+            try:
+                for year in years:
+                    year_zips=[zipcode for each_year, zipcode in mine if each_year == year]
+                    if year_zips:
+                        try:
+                            zbp.fetch_all_zips(year_zips, [year], cache=self, **kwargs)
+                        except zbp.NoDataError:
+                            #None of the zip codes have data for the year, their empty responses are cached all the same
+                            pass
+            finally:
+                #Release the zip codes that failed, so the threads waiting for them try again
+                with self._lock:
+                    failed=[self._inflight.pop(key) for key in mine if key in self._inflight]
+                for future in failed:
+                    future.set_result(False)
+            if all(future.result() for future in waits):
+                return
+
+    def summary(self):
+        return ('Zip code responses in memory: ' + str(len(self)) + ', ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses, '
+                + str(self.coalesced) + ' shared with other requests')
+
+
+class ResultCache:
+    """In-memory LRU cache of the tables of the most recent study areas, computing each one only once across threads."""
+
+    def __init__(self, max_entries=Service_CacheResults):
+        self.max_entries=max_entries
+        self.hits=0
+        self.misses=0
+        self._results=collections.OrderedDict()
+        self._lock=threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, compute):
+        """Return the result of `key`, calling compute() when it isn't cached or being computed by another thread.
+
+        The exception of a failed compute() is raised in every thread that waited for it, and the
+        failure is not cached.
+        """
+        with self._lock:
+            future=self._results.get(key)
+            owner=future is None
+            if owner:
+                future=self._results[key]=Future()
+                self.misses+=1
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+            else:
+                self._results.move_to_end(key)
+                self.hits+=1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(compute())
+        except BaseException as err:
+            with self._lock:
+                if self._results.get(key) is future:
+                    del self._results[key]
+            future.set_exception(err)
+        return future.result()
+
+
+class MarineEconomyService:
+    """The pipeline behind the HTTP service: the zip code and study area caches, and the Census API settings.
+
+    Any extra keyword arguments are passed on to fetch_all_zips, such as base_url, max_workers
+    and zips_per_request.
+    """
+
+    def __init__(self, cache_zips=Service_CacheZips, cache_results=Service_CacheResults, backing=None, **kwargs):
+        self.zip_cache=MemoryCache(cache_zips, backing)
+        self.results=ResultCache(cache_results)
+        self.fetch_kwargs=kwargs
+
+    def tables(self, zips, years, uncertainty=None, names=None):
+        """Return the tables of a study area by name, like run(), from the caches when possible.
+
+        Only the tables in `names` are created when it is given.
+        """
+        zips=sorted(set(zips))
+        years=zbp.parse_years(years)
+        key=(tuple(zips), tuple(years), json.dumps(uncertainty, sort_keys=True), None if names is None else tuple(names))
+
+        def compute():
+            self.zip_cache.fetch(zips, years, **self.fetch_kwargs)
+            return zbp.run(zips, years, cache=self.zip_cache, uncertainty=uncertainty, names=names, **self.fetch_kwargs)
+        return self.results.get(key, compute)
+
+    def workbook(self, tables):
+        """Return the Excel workbook of the tables as bytes."""
+        with tempfile.TemporaryDirectory() as out_dir:
+            path=zbp.write_excel(tables, os.path.join(out_dir, 'Service' + zbp.OutFile_BaseName))
+            with open(path, 'rb') as f:
+                return f.read()
+
+    def status(self):
+        """Return the counts of both caches."""
+        return {'zips_cached':len(self.zip_cache), 'zip_hits':self.zip_cache.hits, 'zip_misses':self.zip_cache.misses
+               ,'zip_requests_shared':self.zip_cache.coalesced
+               ,'results_cached':len(self.results), 'result_hits':self.results.hits, 'result_misses':self.results.misses}
+
+
+class BadRequest(Exception):
+    """A request the service can't answer, returned to the client with HTTP 400."""
+
+
+def parse_request(params):
+    """Check the zips, years, format, tables and uncertainty of a request, and return them with their defaults filled in."""
+    zips=params.get('zips')
+    if isinstance(zips, str):
+        zips=zips.split(',')
+    if not zips or not isinstance(zips, list) or not all(isinstance(zipcode, str) and re.fullmatch(r'\d{5}', zipcode.strip()) for zipcode in zips):
+        raise BadRequest('zips must be a list of 5-digit zip codes')
+    zips=[zipcode.strip() for zipcode in zips]
+    if len(set(zips)) > Service_MaxZips:
+        raise BadRequest('at most ' + str(Service_MaxZips) + ' zip codes can be requested at once')
+    years=params.get('years', zbp.DataYear)
+    if isinstance(years, (int, str)):
+        years=[years]
+    if not years or not isinstance(years, list) or not all(isinstance(year, (int, str)) and not isinstance(year, bool) for year in years):
+        raise BadRequest('years must be a year, a range such as 2012-2016, or a list of years and ranges')
+    try:
+        years=zbp.parse_years(years)
+        for year in years:
+            zbp.naics_vintage(year)
+    except ValueError as err:
+        raise BadRequest('years: ' + str(err))
+    output_format=params.get('format', 'json')
+    if output_format not in ('json', 'xlsx'):
+        raise BadRequest("format must be 'json' or 'xlsx'")
+    tables=params.get('tables')
+    if isinstance(tables, str):
+        tables=tables.split(',')
+    if tables is not None:
+        if not isinstance(tables, list) or not all(isinstance(name, str) for name in tables):
+            raise BadRequest('tables must be a list of table names')
+        unknown=[name for name in tables if name not in zbp.TABLES]
+        if unknown:
+            raise BadRequest('unknown tables: ' + ', '.join(map(str, unknown)))
+    elif output_format == 'json':
+        tables=Service_Tables
+    uncertainty=params.get('uncertainty')
+    if uncertainty in (True, 'true', '1'):
+        uncertainty={}
+    elif uncertainty in (None, False, 'false', '0'):
+        uncertainty=None
+    elif not isinstance(uncertainty, dict) or not set(uncertainty) <= {'draws', 'level', 'max_employees'}:
+        raise BadRequest('uncertainty must be true, false or a dict of draws, level and max_employees')
+    if uncertainty:
+        for name in ['draws', 'max_employees']:
+            if name in uncertainty and (isinstance(uncertainty[name], bool) or not isinstance(uncertainty[name], int)):
+                raise BadRequest('uncertainty ' + name + ' must be a whole number')
+        if 'level' in uncertainty and (isinstance(uncertainty['level'], bool) or not isinstance(uncertainty['level'], (int, float))):
+            raise BadRequest('uncertainty level must be a number')
+        if not 0 <= uncertainty.get('draws', 0) <= Service_MaxDraws:
+            raise BadRequest('uncertainty draws must be from 0 to ' + str(Service_MaxDraws))
+        if not 0 < uncertainty.get('level', zbp.Uncertainty_Level) < 100:
+            raise BadRequest('uncertainty level must be a percent between 0 and 100')
+        if uncertainty.get('max_employees', 1000) < 1000:
+            raise BadRequest('uncertainty max_employees must be 1000 or more, the lowest of the 1,000 or more size class')
+    return zips, years, output_format, tables, uncertainty
+
+
+def table_records(df):
+    """Return the rows of a table as a list of dicts of JSON values, with None for missing values."""
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    """Answer POST /analysis, GET /analysis and GET /status with the tables and cache counts of `service`."""
+
+    service=None
+
+    def do_GET(self):
+        url=urllib.parse.urlparse(self.path)
+        if url.path == '/status':
+            self.send_json(200, self.service.status())
+        elif url.path == '/analysis':
+            self.analysis({key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()})
+        else:
+            self.send_json(404, {'error':'unknown path ' + url.path})
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != '/analysis':
+            self.send_json(404, {'error':'unknown path ' + self.path})
+            return
+        try:
+            params=json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            self.send_json(400, {'error':'the request body is not valid JSON'})
+            return
+        if not isinstance(params, dict):
+            self.send_json(400, {'error':'the request body must be a JSON object'})
+            return
+        self.analysis(params)
+
+    def analysis(self, params):
+        try:
+            zips, years, output_format, names, uncertainty=parse_request(params)
+            tables=self.service.tables(zips, years, uncertainty, names)
+        except BadRequest as err:
+            self.send_json(400, {'error':str(err)})
+            return
+        except zbp.NoDataError as err:
+            #There is no data for any of the zip codes
+            self.send_json(404, {'error':str(err)})
+            return
+        except (OSError, zbp.ResponseTooLarge) as err:
+            #URLError, HTTPError and socket timeouts are all OSErrors
+            self.send_json(502, {'error':'Census API request failed: ' + str(err)})
+            return
+        except Exception as err:
+            self.send_json(500, {'error':type(err).__name__ + ': ' + str(err)})
+            return
+        if output_format == 'xlsx':
+            self.send_body(200, self.service.workbook(tables), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+                           , {'Content-Disposition':'attachment; filename="MarineEconomy.xlsx"'})
+        else:
+            #The year-over-year tables are left out for a single year
+            self.send_json(200, {'zips':zips, 'years':years, 'tables':{name: table_records(tables[name]) for name in names if name in tables}})
+
+    def send_json(self, status, value):
+        self.send_body(status, json.dumps(value).encode(), 'application/json')
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(service, port=Service_Port, host=Service_Host):
+    """Return a threading HTTP server answering requests with `service`. Port 0 picks a free port."""
+    handler=type('Handler', (ServiceHandler,), {'service':service})
+    server=http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads=True
+    return server
+
+
+def serve(service, port=0, host=Service_Host):
+    """Start the service in a background thread and return the server and its url. Call server.shutdown() to stop it."""
+    server=make_server(service, port, host)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://' + host + ':' + str(server.server_address[1]) + '/'
+
+
+def main(argv=None):
+    """Command line entry point: serve the analysis until interrupted."""
+    parser=argparse.ArgumentParser(description='Serve the local marine economy analysis over HTTP.')
+    parser.add_argument('--port', type=int, default=Service_Port, help='port to listen on')
+    parser.add_argument('--host', default=Service_Host, help='address to listen on')
+    parser.add_argument('--cache-zips', type=int, default=Service_CacheZips, help='number of zip code and year responses kept in memory')
+    parser.add_argument('--cache-results', type=int, default=Service_CacheResults, help='number of study area results kept in memory')
+    parser.add_argument('--cache-dir', help='folder of cached Census API responses behind the memory cache (default: ' + str(zbp.Cache_Dir)
+                                            + ' in the working folder)')
+    parser.add_argument('--no-cache', action='store_true', help='only keep responses in memory')
+    parser.add_argument('--census-url', default=zbp.Census_BaseURL, help='base url of the Census API')
+    parser.add_argument('--workers', type=int, default=zbp.Fetch_MaxWorkers, help='number of API requests sent at the same time')
+    parser.add_argument('--zips-per-request', type=int, default=zbp.Fetch_ZipsPerRequest, help='number of zip codes packed into one API request')
+    args=parser.parse_args(argv)
+
+    #The service writes no output folder, so the cache folder setting is taken from the working folder
+    CacheDir=args.cache_dir if args.cache_dir is not None else zbp.output_folder(os.getcwd(), zbp.Cache_Dir)
+    Backing=None if args.no_cache or CacheDir is None else zbp.ZBPCache(CacheDir, max_bytes=zbp.Cache_MaxMB * 1024 * 1024, base_url=args.census_url)
+    Service=MarineEconomyService(args.cache_zips, args.cache_results, Backing, base_url=args.census_url, max_workers=args.workers,
+                                 zips_per_request=args.zips_per_request)
+    server=make_server(Service, args.port, args.host)
+    print('Serving the marine economy analysis at http://' + args.host + ':' + str(args.port) + '/analysis')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        print(Service.zip_cache.summary())
+
+
+if __name__ == '__main__':
+    main()
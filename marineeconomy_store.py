@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+This script keeps the Zip Code Business Patterns data in a local SQLite database, so that the marine economy of any study area can be answered from the database in well under a second instead of a fresh download. The script will go through the following processes:
+
+
+*   Creating the database, with the ZBP rows indexed on (year, zip code, NAICS code, employment size class), and the midpoint and marine sector crosswalk tables next to them
+*   Loading the zip codes and years that aren't in the database yet, from the Census API or from ZBP detail files
+*   Querying the Total Economy, the Marine Economy and the zip code, year and industry totals of a study area
+*   Rolling the analysis tables up from those totals, and writing the outputs
+
+The database holds the cleaned rows (6-digit NAICS codes, size classes with establishments), so a study area is only ever downloaded once.
+
+Example:
+
+    python -m marineeconomy_store zbp.sqlite --zips 54880 55807 55811 --years 2012-2016 --out-dir C:\\Data\\Out --prefix Sample
+    python -m marineeconomy_store zbp.sqlite --detail-files zbp16detail.zip
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+import marineeconomy_zbp_retrieval_analysis as zbp
+
+Store_Schema='''
+CREATE TABLE IF NOT EXISTS zbp (
+    year TEXT NOT NULL,
+    zipcode TEXT NOT NULL,
+    naics TEXT NOT NULL,
+    empszes TEXT NOT NULL,
+    geo_name TEXT,
+    industry_name TEXT,
+    empszes_ttl TEXT,
+    estab INTEGER NOT NULL,
+    PRIMARY KEY (year, zipcode, naics, empszes)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS loaded (
+    year TEXT NOT NULL,
+    zipcode TEXT NOT NULL,
+    PRIMARY KEY (year, zipcode)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS midpoints (
+    empszes TEXT PRIMARY KEY,
+    midpoint REAL NOT NULL
+);
+DROP TABLE IF EXISTS crosswalk;
+CREATE TABLE crosswalk (
+    vintage TEXT NOT NULL,
+    naics TEXT NOT NULL,
+    marine_sector TEXT NOT NULL,
+    PRIMARY KEY (vintage, naics)
+);
+CREATE TABLE IF NOT EXISTS naics_years (
+    year TEXT PRIMARY KEY,
+    vintage TEXT NOT NULL
+);
+'''
+
+#Columns of the zbp table, in the order of the TotalEconomy_df columns they hold
+Store_Columns={'Zipcode':'zipcode', 'GeoName':'geo_name', 'Year':'year', 'NAICS':'naics', 'Industry Name':'industry_name'
+              ,'Establishments':'estab', 'Employment Size Class Code':'empszes', 'Employment Size Class':'empszes_ttl'}
+
+
+class ZBPStore:
+    """SQLite database of cleaned ZBP rows, with the midpoint and marine sector crosswalk tables.
+
+    The midpoints and crosswalk are replaced by `midpoint_df` and `marinesector_df` each time the
+    database is opened, so they always match the script. The rows of each year are matched with
+    the crosswalk of the NAICS vintage of the year.
+    """
+
+    def __init__(self, path, midpoint_df=zbp.midpoint_df, marinesector_df=zbp.marinesector_df):
+        self.path=path
+        self.midpoint_df=midpoint_df
+        self.marinesector_df=marinesector_df
+        self.connection=sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript(Store_Schema)
+            self.connection.execute('DELETE FROM midpoints')
+            self.connection.executemany('INSERT INTO midpoints VALUES (?, ?)'
+                                        , zip(midpoint_df['Employment Size Class Code'], pd.to_numeric(midpoint_df['Midpoint'])))
+            self.connection.executemany('INSERT INTO crosswalk VALUES (?, ?, ?)'
+                                        , zip(marinesector_df['NAICS Vintage'], marinesector_df['NAICS'], marinesector_df['Marine Sector']))
+
+    def close(self):
+        self.connection.close()
+
+    def missing(self, zips, years):
+        """Return the (year, zip code) pairs of `zips` and `years` that haven't been loaded yet."""
+        loaded=set(self.connection.execute('SELECT year, zipcode FROM loaded'))
+        return [(year, zipcode) for year in zbp.parse_years(years) for zipcode in zips if (year, zipcode) not in loaded]
+
+    def ingest(self, df_AllZips, pairs=None):
+        """Clean df_AllZips and save its rows, replacing any rows already saved for the same keys.
+
+        `pairs` lists the (year, zip code) pairs the data covers, including those with no data, so
+        they are never loaded again. By default they are the pairs found in df_AllZips.
+        """
+        TotalEconomy_df=zbp.clean(df_AllZips, self.midpoint_df)
+        rows=TotalEconomy_df[list(Store_Columns)].astype({'Establishments':'int64'}).astype(object)
+        if pairs is None:
+            pairs=df_AllZips[['Year','Zipcode']].drop_duplicates().itertuples(index=False, name=None)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO zbp (' + ', '.join(Store_Columns.values()) + ') VALUES ('
+                                        + ', '.join('?' * len(Store_Columns)) + ')', rows.itertuples(index=False, name=None))
+            self.connection.executemany('INSERT OR IGNORE INTO loaded VALUES (?, ?)', pairs)
+        return len(rows)
+
+    def load(self, zips, years, cache=None, **kwargs):
+        """Fetch and save the zip codes and years that aren't in the database yet. Returns the number of pairs fetched.
+
+        Any extra keyword arguments are passed on to fetch_all_zips.
+        """
+        missing=self.missing(zips, years)
+        for year in sorted({year for year, _ in missing}):
+            year_zips=[zipcode for each_year, zipcode in missing if each_year == year]
+            try:
+                df_AllZips=zbp.fetch(year_zips, [year], cache=cache, **kwargs)
+            except zbp.NoDataError:
+                #None of the zip codes have data for the year. Any other error is raised, so the zip codes are fetched again next time
+                df_AllZips=pd.DataFrame(columns=list(Store_Columns))
+            self.ingest(df_AllZips, pairs=[(year, zipcode) for zipcode in year_zips])
+        return len(missing)
+
+    def ingest_detail(self, path, zips=None, **kwargs):
+        """Save the rows of `zips` (every zip code when None) from a ZBP detail file. Any extra keyword arguments are passed on to read_zbp_detail."""
+        return self.ingest(zbp.read_zbp_detail(path, zips, **kwargs))
+
+    def query(self, sql, zips, years):
+        """Run `sql`, whose WHERE clause holds {years} and then {zips} placeholders, for a study area and return a dataframe."""
+        years=zbp.parse_years(years)
+        #The NAICS vintage of each year, used to match the rows of each year with the crosswalk of their vintage
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO naics_years VALUES (?, ?)', [(year, zbp.naics_vintage(year)) for year in years])
+        sql=sql.format(zips=', '.join('?' * len(zips)), years=', '.join('?' * len(years)))
+        return pd.read_sql_query(sql, self.connection, params=list(years) + list(zips))
+
+    def total_econ(self, zips, years):
+        """Return the TotalEcon dataframe of a study area: its rows, with their midpoints and employment estimates."""
+        TotalEcon=self.query('SELECT ' + ', '.join('z.' + column + ' AS "' + name + '"' for name, column in Store_Columns.items())
+                             + ', m.midpoint AS "Midpoint", z.estab * m.midpoint AS "Employment Estimate"'
+                             ' FROM zbp z JOIN midpoints m ON m.empszes = z.empszes'
+                             ' WHERE z.year IN ({years}) AND z.zipcode IN ({zips})'
+                             ' ORDER BY z.year, z.zipcode, z.naics, z.empszes', zips, years)
+        return self.categoricals(TotalEcon)
+
+    def marine(self, zips, years):
+        """Return the Marine_df dataframe of a study area: the TotalEcon rows of marine industries, with their marine sector."""
+        Marine_df=self.query('SELECT ' + ', '.join('z.' + column + ' AS "' + name + '"' for name, column in Store_Columns.items())
+                             + ', m.midpoint AS "Midpoint", z.estab * m.midpoint AS "Employment Estimate", c.marine_sector AS "Marine Sector"'
+                             ' FROM zbp z JOIN midpoints m ON m.empszes = z.empszes JOIN naics_years y ON y.year = z.year'
+                             ' JOIN crosswalk c ON c.vintage = y.vintage AND c.naics = z.naics'
+                             ' WHERE z.year IN ({years}) AND z.zipcode IN ({zips})'
+                             ' ORDER BY z.year, z.zipcode, z.naics, z.empszes', zips, years)
+        Marine_df=self.categoricals(Marine_df)
+        Marine_df['Marine Sector']=pd.Categorical(Marine_df['Marine Sector'], categories=sorted(self.marinesector_df['Marine Sector'].unique()))
+        return Marine_df
+
+    def industry_totals(self, zips, years):
+        """Return the establishments and employment of each zip code, year and NAICS code of a study area (EconByIndustry)."""
+        EconByIndustry=self.query('SELECT z.zipcode AS "Zipcode", z.geo_name AS "GeoName", z.year AS "Year", z.naics AS "NAICS"'
+                                  ', z.industry_name AS "Industry Name", SUM(z.estab) AS "Establishments"'
+                                  ', SUM(z.estab * m.midpoint) AS "Employment Estimate"'
+                                  ' FROM zbp z JOIN midpoints m ON m.empszes = z.empszes'
+                                  ' WHERE z.year IN ({years}) AND z.zipcode IN ({zips})'
+                                  ' GROUP BY z.year, z.zipcode, z.naics, z.geo_name, z.industry_name', zips, years)
+        return self.categoricals(EconByIndustry)
+
+    @staticmethod
+    def categoricals(df):
+        """Store the code and name columns of a query result as categoricals, like clean() does."""
+        return df.astype({column:'category' for column in ['Zipcode','GeoName','Year','NAICS','Industry Name','Employment Size Class Code'
+                                                           ,'Employment Size Class'] if column in df.columns})
+
+    def tables(self, zips, years, data=True):
+        """Return the output tables of a study area by name, like run(). The data tables are left out when `data` is False."""
+        tables=zbp.analysis_tables(self.industry_totals(zips, years), self.marinesector_df)
+        if data:
+            tables['TotalEconomy_Data']=self.total_econ(zips, years)
+            tables['MarineSectors_Data']=self.marine(zips, years)
+        return tables
+
+
+def main(argv=None):
+    """Command line entry point of the store."""
+    parser=argparse.ArgumentParser(description='Load ZBP data into a local database and answer study area queries from it.')
+    parser.add_argument('database', help='SQLite database file (created when it doesn\'t exist)')
+    parser.add_argument('-z', '--zips', nargs='+', help='zip codes of the study area')
+    parser.add_argument('-y', '--years', nargs='+', default=zbp.parse_years(zbp.DataYear), help='years of data, such as 2016 or 2012-2016')
+    parser.add_argument('-o', '--out-dir', help='folder where the output is saved (default: only print Table 1)')
+    parser.add_argument('-p', '--prefix', default=zbp.OutFile_NamePrefix, help="output file name prefix, followed by '" + zbp.OutFile_BaseName + "'")
+    parser.add_argument('-f', '--formats', nargs='+', default=zbp.Output_Formats, choices=sorted(zbp.OUTPUT_WRITERS), help='output formats to write')
+    parser.add_argument('--detail-files', nargs='+', default=[], metavar='PATH', help='ZBP detail files to load into the database (every zip code, or only --zips)')
+    parser.add_argument('--naics-titles', metavar='PATH', help='NAICS titles file used with --detail-files')
+    parser.add_argument('--census-url', default=zbp.Census_BaseURL, help='base url of the Census API')
+    parser.add_argument('--workers', type=int, default=zbp.Fetch_MaxWorkers, help='number of API requests sent at the same time')
+    parser.add_argument('--zips-per-request', type=int, default=zbp.Fetch_ZipsPerRequest, help='number of zip codes packed into one API request')
+    args=parser.parse_args(argv)
+
+    store=ZBPStore(args.database)
+    titles=zbp.read_naics_titles(args.naics_titles) if args.naics_titles else None
+    for path in args.detail_files:
+        print('Loaded ' + str(store.ingest_detail(path, args.zips, naics_titles=titles)) + ' rows from ' + path)
+    if args.zips:
+        fetched=store.load(args.zips, args.years, base_url=args.census_url, max_workers=args.workers, zips_per_request=args.zips_per_request)
+        if fetched:
+            print('Loaded ' + str(fetched) + ' zip code and year pairs from the Census API')
+
+        start_time=time.perf_counter()
+        tables=store.tables(args.zips, args.years, data=args.out_dir is not None)
+        print('Study area queried in ' + str(round(time.perf_counter() - start_time, 3)) + ' s')
+        if args.out_dir is not None:
+            zbp.write(tables, os.path.join(args.out_dir, args.prefix + zbp.OutFile_BaseName), args.formats)
+        else:
+            print(tables['Table1_Analysis'].to_string(index=False))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+This script creates synthetic Zip Code Business Patterns data and serves it from a local stand-in for the Census API, so the marine economy pipeline can be run and timed without calling api.census.gov.
+
+The responses have the same shape as the Census API: a JSON list of rows, with the column headers (GEO_TTL, YEAR, NAICS2012_TTL, EMPSZES, EMPSZES_TTL, ESTAB, NAICS2012, zipcode) in the first row. Each zip code has its own mix of industries, including the marine industries and the sector level NAICS codes that the cleaning step removes, and its establishments are spread over the employment size classes the way small businesses usually are. The data of a zip code and year is always the same, so runs can be compared with each other.
+
+The server can also fail on purpose, to exercise the retries and the splitting of requests of the pipeline: each request can be answered with an error status the first few times it is made, and requests for more zip codes than a limit can be refused, like a url that is too long.
+
+Example, serving the synthetic data on port 8765:
+
+    python -m marineeconomy_synthetic --port 8765
+    python -m marineeconomy_zbp_retrieval_analysis --census-url http://127.0.0.1:8765/data/ --no-cache
+"""
+
+import argparse
+import collections
+import functools
+import http.server
+import json
+import random
+import threading
+import urllib.parse
+
+import marineeconomy_zbp_retrieval_analysis as zbp
+
+#Employment size class codes and titles, with the share of establishments in each class
+SizeClasses=[('212','Establishments with 1 to 4 employees',0.55)
+            ,('220','Establishments with 5 to 9 employees',0.2)
+            ,('230','Establishments with 10 to 19 employees',0.12)
+            ,('241','Establishments with 20 to 49 employees',0.08)
+            ,('242','Establishments with 50 to 99 employees',0.03)
+            ,('251','Establishments with 100 to 249 employees',0.015)
+            ,('252','Establishments with 250 to 499 employees',0.003)
+            ,('254','Establishments with 500 to 999 employees',0.0015)
+            ,('260','Establishments with 1,000 employees or more',0.0005)]
+
+#2-digit NAICS sectors the synthetic industries are drawn from
+Sectors=['11','21','22','23','31','32','33','42','44','45','48','49','51','52','53','54','55','56','61','62','71','72','81']
+
+
+def naics_universe(size=1000, seed=0):
+    """Return the 6-digit NAICS codes synthetic zip codes draw their industries from: the marine codes and `size` other codes."""
+    r=random.Random(seed)
+    codes=dict.fromkeys(zbp.marinesector_df['NAICS'])
+    while len(codes) < size + len(zbp.marinesector_df):
+        codes[r.choice(Sectors) + str(r.randrange(1000, 10000))]=None
+    return list(codes)
+
+
+def synthetic_zips(count, first=10001):
+    """Return `count` 5-digit zip codes."""
+    return [str(zipcode).zfill(5) for zipcode in range(first, first + count)]
+
+
+def synthetic_rows(zipcode, year, naics_variable='NAICS2012', seed=0, universe=None):
+    """Return the synthetic API response rows of one zip code and year, with the column headers in row 0.
+
+    Every NAICS code of the zip code has an 'All Establishments' row (001) and a row for each
+    employment size class, many of them with 0 establishments, like the Census API.
+    """
+    universe=universe if universe is not None else naics_universe(seed=seed)
+    r=random.Random(str(seed) + ':' + zipcode + ':' + year)
+    geo_name='ZIP ' + zipcode + ' (Synthetic, XX)'
+    industries=sorted(r.sample(universe, r.randint(10, 200)))
+    #The total of all sectors (00) and the 2-digit sector totals are removed by the cleaning step
+    codes=['00'] + sorted({naics[:2] for naics in industries}) + industries
+
+    rows=[['GEO_TTL','YEAR',naics_variable + '_TTL','EMPSZES','EMPSZES_TTL','ESTAB',naics_variable,'zipcode']]
+    for naics in codes:
+        total=max(1, int(r.expovariate(1 / 6)))
+        counts=[0] * len(SizeClasses)
+        for size_class in r.choices(range(len(SizeClasses)), weights=[share for _, _, share in SizeClasses], k=total):
+            counts[size_class] += 1
+        title='Industry ' + naics
+        rows.append([geo_name, year, title, '001', 'All establishments', str(total), naics, zipcode])
+        rows.extend([geo_name, year, title, code, name, str(count), naics, zipcode] for (code, name, _), count in zip(SizeClasses, counts))
+    return rows
+
+
+class SyntheticCensusHandler(http.server.BaseHTTPRequestHandler):
+    """Answer Census API ZBP requests (/data/<year>/zbp?get=...&for=zipcode:...&NAICS2012=*) with synthetic rows.
+
+    The failures to inject are read from the server (see make_server), and every request is logged
+    in its `requests` list as (number of zip codes, status).
+    """
+
+    seed=0
+
+    def log_message(self, format, *args):
+        pass
+
+    def injected_failure(self, zips):
+        """Return the error status to answer this request with, or None to answer it with data."""
+        server=self.server
+        with server.lock:
+            server.attempts[self.path]+=1
+            if server.max_zips is not None and len(zips) > server.max_zips:
+                status=414
+            elif server.attempts[self.path] <= server.fail_first:
+                status=server.fail_status
+            else:
+                status=None
+            server.requests.append((len(zips), status or 200))
+        return status
+
+    def do_GET(self):
+        url=urllib.parse.urlparse(self.path)
+        query=urllib.parse.parse_qs(url.query)
+        year=url.path.rstrip('/').split('/')[-2]
+        #The NAICS variable of the request (NAICS2012, NAICS2017, ...) names the NAICS columns of the response
+        naics_variable=next((key for key in query if key.startswith('NAICS')), 'NAICS2012')
+        zips=query['for'][0].split(':')[1].split(',')
+        status=self.injected_failure(zips)
+        if status is not None:
+            self.send_error(status)
+            return
+        rows=[]
+        for zipcode in zips:
+            zip_rows=cached_rows(zipcode, year, naics_variable, self.seed)
+            rows.extend(zip_rows if not rows else zip_rows[1:])
+        body=json.dumps(rows).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@functools.lru_cache(maxsize=None)
+def cached_universe(seed):
+    return naics_universe(seed=seed)
+
+
+@functools.lru_cache(maxsize=20000)
+def cached_rows(zipcode, year, naics_variable, seed):
+    return synthetic_rows(zipcode, year, naics_variable, seed, cached_universe(seed))
+
+
+def make_server(port, host, fail_first=0, fail_status=503, max_zips=None):
+    """Return the stand-in Census API server, not started yet.
+
+    Each distinct request is answered with `fail_status` the first `fail_first` times it is made,
+    and requests for more than `max_zips` zip codes are always answered with HTTP 414 (URI Too
+    Long).
+    """
+    server=http.server.ThreadingHTTPServer((host, port), SyntheticCensusHandler)
+    server.daemon_threads=True
+    server.fail_first=fail_first
+    server.fail_status=fail_status
+    server.max_zips=max_zips
+    server.lock=threading.Lock()
+    server.attempts=collections.Counter()
+    server.requests=[]
+    return server
+
+
+def serve(port=0, host='127.0.0.1', **failures):
+    """Start the stand-in Census API in a background thread and return the server and its base url.
+
+    Port 0 picks a free port. The failures to inject are passed on to make_server. Call
+    server.shutdown() to stop it.
+    """
+    server=make_server(port, host, **failures)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://' + host + ':' + str(server.server_address[1]) + '/data/'
+
+
+def main(argv=None):
+    """Command line entry point: serve the synthetic data until interrupted."""
+    parser=argparse.ArgumentParser(description='Serve synthetic Zip Code Business Patterns data in the shape of the Census API.')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--fail-first', type=int, default=0, help='answer each request with --fail-status the first N times it is made')
+    parser.add_argument('--fail-status', type=int, default=503, help='HTTP status of the failures of --fail-first')
+    parser.add_argument('--max-zips', type=int, help='answer requests for more zip codes than this with HTTP 414')
+    args=parser.parse_args(argv)
+
+    server=make_server(args.port, args.host, fail_first=args.fail_first, fail_status=args.fail_status, max_zips=args.max_zips)
+    print('Serving synthetic ZBP data at http://' + args.host + ':' + str(args.port) + '/data/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
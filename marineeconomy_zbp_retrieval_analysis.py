@@ -10,25 +10,46 @@ This is a python 3.X script designed to access Census Zip Code Business Patterns
 *   Creating analysis tables for output
 *   Writing the outputs into an Excel file
 
+Each of these steps is a function (fetch, clean, enrich, aggregate and write), and run() chains them together, so the pipeline can be imported and run many times from another program without any work being done at import time. From the command line, the script runs with the inputs set below, or with the ones given as arguments:
+
+    python -m marineeconomy_zbp_retrieval_analysis --zips 54880 55807 --years 2012-2016 --out-dir C:\Data\Out --prefix Sample
+
 # Import Libraries, Set Parameters
 
 The first step is to import the libraries necessary to execute the script, as well as set up the dynamic input parameters.
 """
 
 import pandas as pd
+import numpy as np
+import argparse
+import contextlib
+import cProfile
 import datetime
-
-StartTime = datetime.datetime.now()
-print('Starting at ' + StartTime.strftime("%I:%M:%S %p"))
+import functools
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import xlsxwriter
+from concurrent.futures import ThreadPoolExecutor
 
 #################################################################################################
 """
-The following items are the inputs to be changed by the user
+The following items are the inputs to be changed by the user. They are used when the script is run without command line arguments.
 """
 #This is the list of zip codes requested. These codes will be passed into the url of the API request. If just a single zip code, it will need a comma at the end.
 zip_list='54880','55807','55811','55806','55804','55616'
 
 #The year of the data requested. Check the Census Zip Code Business Patterns API to see what years of data are available: https://www.census.gov/data/developers/data-sets/cbp-nonemp-zbp/zbp-api.html
+#For a multi-year panel, give a range such as '2012-2016' or a list of years such as '2012','2014','2016'. Every year is
+#fetched in the same run, the output tables get one row per year, and year-over-year change tables are added.
 DataYear='2016'
 
 #Set your file path where the output will be saved
@@ -44,11 +65,148 @@ The following items are do not need to be changed, but can be if desired
 #Midpoints that will be matched up to employment range codes. These can be customized by the user
 Midpoint_List='2.5','7','14.5','34.5','74.5','174.5','374.5','749.5','1000'
 
-#Output file information
-OutFile_BaseName='_MarineEconomy.xlsx'
-OutFile_Name=OutFile_NamePrefix + OutFile_BaseName
-OutFile=OutFile_Loc + '\\' + OutFile_Name
-print('Output file: ' + OutFile)
+#Census API settings. The base url can be pointed at a local stand-in server to run the script offline
+Census_BaseURL='https://api.census.gov/data/'
+
+#Number of zip code requests sent to the Census API at the same time
+Fetch_MaxWorkers=8
+
+#Seconds to wait for a single request before it is treated as failed
+Fetch_Timeout=30
+
+#Number of times a failed request is retried, and the wait in seconds before the first retry (doubled after each retry)
+Fetch_Retries=3
+Fetch_Backoff=1
+
+#Number of zip codes packed into a single API request. 1 requests every zip code on its own. Larger values (e.g. 50)
+#cut the number of requests for big studies; a request that fails or is too large is split in half automatically
+Fetch_ZipsPerRequest=1
+
+#Largest API response in megabytes accepted for a multi zip code request before it is split in half
+Fetch_MaxResponseMB=50
+
+#Folder where Census API responses are saved so that reruns never download them again, inside the output folder unless it is
+#a full path. Set to None to turn the cache off
+Cache_Dir='zbp_cache'
+
+#Largest size of the cache folder in megabytes. The least recently used responses are removed past this size
+Cache_MaxMB=500
+
+#Set to True to delete the cached responses for the years in DataYear before running, forcing a fresh download
+Cache_Invalidate=False
+
+#Folder where the cleaned rows and totals of each zip code and year are saved, so that a run only processes the zip codes that
+#weren't in an earlier run and recombines the rest. It is inside the output folder unless it is a full path. Set to None to
+#process every zip code on every run
+Partials_Dir='zbp_partials'
+
+#Folder of the marine sector crosswalk files, one for each NAICS vintage
+Crosswalk_Dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crosswalks')
+
+#ZBP detail files (zbpYYdetail.txt or .zip, downloaded from https://www.census.gov/programs-surveys/cbp/data/datasets.html) to read
+#instead of calling the Census API, one per year, and an optional file of NAICS titles (code, title) for the Industry Name column.
+#The detail files are read Detail_ChunkRows rows at a time, keeping only the requested zip codes
+Detail_Files=[]
+Detail_NAICSTitles=None
+Detail_ChunkRows=500000
+
+#Uncertainty mode adds the lowest and highest employment allowed by the size classes to Tables 1 to 5, and a confidence interval
+#from Uncertainty_Draws simulated draws of the number of employees of every establishment (0 to only add the lowest and highest).
+#The 1,000 or more class has no upper limit, so Uncertainty_MaxEmployees is used as its highest number of employees. The draws
+#are simulated Uncertainty_BatchCells values at a time to bound the memory used, with a fixed seed so runs can be repeated
+Uncertainty=False
+Uncertainty_Draws=1000
+Uncertainty_Level=95
+Uncertainty_MaxEmployees=2000
+Uncertainty_BatchCells=5000000
+Uncertainty_Seed=0
+
+#Write the Excel file in constant memory mode: each row is flushed to disk as soon as the next row is started, so the
+#memory used no longer grows with the size of the TotalEconomy_Data and MarineSectors_Data sheets
+Excel_ConstantMemory=True
+
+#Number of rows converted from a dataframe to Excel cells at a time
+Excel_ChunkRows=10000
+
+#Output formats to write. 'excel' creates the formatted workbook. 'parquet', 'feather' and 'csv' (gzip compressed) write each
+#table to its own file, in a folder named like the workbook, for programs that load the tables back in. Parquet and Feather need the pyarrow package
+Output_Formats=['excel']
+
+#Output file information. The file name is the prefix followed by the base name, and each output format adds its own file extension
+OutFile_BaseName='_MarineEconomy'
+
+"""# Run Report
+
+Each step of the pipeline records how long its stages take, how many rows go in and come out, and the peak memory of the process, into a RunReport. The report can be saved as JSON, to tell whether a slow run is waiting on the Census API, the pandas joins or the Excel writing.
+"""
+
+def peak_rss_mb():
+    """Return the peak memory used by this process in megabytes, or None where it can't be measured (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class RunReport:
+    """Elapsed time, rows in and out, and peak memory of each stage of a run.
+
+    Stages are recorded with the stage() context manager, or with add() when they were timed
+    elsewhere. Stages can be recorded from several threads at once.
+    """
+
+    def __init__(self):
+        self.started=datetime.datetime.now()
+        self.stages=[]
+        self._lock=threading.Lock()
+
+    def add(self, stage, seconds, detail=None, rows_in=None, rows_out=None, peak_mb=None):
+        """Record a stage that took `seconds`. The peak memory is measured now unless `peak_mb` is given."""
+        peak_mb=peak_mb if peak_mb is not None else peak_rss_mb()
+        record={'stage':stage, 'detail':detail, 'seconds':round(seconds, 4), 'rows_in':rows_in, 'rows_out':rows_out
+               ,'peak_mb':None if peak_mb is None else round(peak_mb, 1)}
+        with self._lock:
+            self.stages.append(record)
+        return record
+
+    @contextlib.contextmanager
+    def stage(self, stage, detail=None, rows_in=None):
+        """Time the block of a with statement as a stage.
+
+        The block is given a dict, and sets its 'rows_out' key to record the rows the stage produced.
+        """
+        result={'rows_out':None}
+        start_time=time.perf_counter()
+        yield result
+        self.add(stage, time.perf_counter() - start_time, detail, rows_in, result['rows_out'])
+
+    def to_dict(self):
+        """Return the report as a dict: the stages in the order they finished, and the total time of each kind of stage.
+
+        Stages that ran at the same time in several threads, like the API requests, add up to more
+        than the time they took together.
+        """
+        totals={}
+        for record in self.stages:
+            total=totals.setdefault(record['stage'], {'count':0, 'seconds':0.0})
+            total['count'] += 1
+            total['seconds']=round(total['seconds'] + record['seconds'], 4)
+        peak_mb=peak_rss_mb()
+        return {'started':self.started.isoformat(timespec='seconds')
+               ,'seconds':round((datetime.datetime.now() - self.started).total_seconds(), 4)
+               ,'peak_mb':None if peak_mb is None else round(peak_mb, 1)
+               ,'totals':totals
+               ,'stages':self.stages}
+
+    def save(self, path):
+        """Write the report to `path` as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
 
 """# Accessing the Census API
 
@@ -58,6 +216,8 @@ Documentation: https://api.census.gov/data/2016/zbp/variables.html
 
 Example: https://api.census.gov/data/2016/zbp?get=GEO_ID,GEO_TTL,YEAR,NAICS2012_TTL,ESTAB,EMPSZES,EMPSZES_TTL,EMP&for=zipcode:07701,07716&NAICS2012=*
 
+The NAICS variables are named after the NAICS vintage the data year is coded in: NAICS2012 for 2012 to 2016, NAICS2017 from 2017 and NAICS2022 from 2022. The url of each year uses the variable of its vintage, and the NAICS columns of every response are renamed to NAICS and NAICS_TTL, so years coded in different vintages can be stacked together.
+
 The base url:
 https://api.census.gov/data/2016/zbp?get=
 
@@ -72,32 +232,414 @@ The attribute requested:
 *   NAICS2012 = 6-digit industrial codes data are requested for (* is for all codes)
 """
 
-#Loop through creating an API request using each zip code in the list individually.
-#This is to get around a Census API limitation
-print('Accessing zip code data from the Census API')
-df_AllZips = []
-for zip in zip_list:
-  df='df_' +  zip
-  url='https://api.census.gov/data/' + DataYear + '/zbp?get=GEO_TTL,YEAR,NAICS2012_TTL,EMPSZES,EMPSZES_TTL,ESTAB&for=zipcode:'+ zip + '&NAICS2012=*'
-  df= pd.read_json(url, orient='values')
-  print('Data for zip code ' + zip + ' is being accessed')
-  #Set the location of the column headers to be row 0
-  df.columns = df.iloc[0]
-  #Re-index the data to use the new column headers and drop row 0 from the data values
-  df.reindex(df.index.drop(0))
-  #Set the dataframe data values to start at row w
-  df =df [1:]
-  df_AllZips.append(df)
-df_AllZips=pd.concat(df_AllZips, ignore_index=True)
-
-print ('All zip codes have been accessed, creating Total Economy table')
-
-#Set the order of the columns
-df_AllZips=df_AllZips[['zipcode','GEO_TTL','YEAR','NAICS2012','NAICS2012_TTL','ESTAB','EMPSZES','EMPSZES_TTL']]
-#Rename Columns
-df_AllZips.rename(columns={'zipcode':'Zipcode','GEO_TTL':'GeoName','YEAR':'Year','NAICS2012':'NAICS'
-                           ,'NAICS2012_TTL':'Industry Name','ESTAB':'Establishments','EMPSZES':'Employment Size Class Code'
-                           ,'EMPSZES_TTL':'Employment Size Class'}, inplace=True)
+#First data year of each NAICS vintage. ZBP data before 2012 is coded in NAICS 2007, which has no marine sector crosswalk
+NAICS_Vintages=['2012','2017','2022']
+
+def naics_vintage(year):
+    """Return the NAICS vintage the data of a year is coded in ('2012', '2017' or '2022')."""
+    vintages=[vintage for vintage in NAICS_Vintages if int(year) >= int(vintage)]
+    if not vintages:
+        raise ValueError('There is no marine sector crosswalk for ' + str(year) + ', the first NAICS vintage supported is ' + NAICS_Vintages[0])
+    return vintages[-1]
+
+
+def naics_variable(year):
+    """Return the Census API NAICS variable of a year, such as NAICS2012."""
+    return 'NAICS' + naics_vintage(year)
+
+
+
+#Zip codes are requested in chunks of Fetch_ZipsPerRequest (individually by default, to get around a Census API
+#limitation). The requests are sent concurrently by a pool of worker threads, so the total time is no longer the
+#sum of every round-trip.
+class ResponseTooLarge(Exception):
+    """Raised when an API response is larger than the limit set for a request."""
+
+
+class NoDataError(ValueError):
+    """Raised when none of the requested zip codes have data, as opposed to a request or response that failed."""
+
+
+def build_zbp_url(zips, year, base_url=Census_BaseURL):
+    """Return the Census API url for the ZBP data of a list of zip codes and a year."""
+    variable=naics_variable(year)
+    return (base_url + year + '/zbp?get=GEO_TTL,YEAR,' + variable + '_TTL,EMPSZES,EMPSZES_TTL,ESTAB&for=zipcode:'
+            + ','.join(zips) + '&' + variable + '=*')
+
+
+def fetch_rows(zips, year, base_url=Census_BaseURL, timeout=Fetch_Timeout, retries=Fetch_Retries, backoff=Fetch_Backoff,
+               max_bytes=None):
+    """Request the ZBP data for a list of zip codes and return the rows of the API response.
+
+    The first row holds the column headers. An empty list is returned when the API has no data for
+    the zip codes. Connection errors, timeouts, rate limiting (HTTP 429) and server errors are
+    retried up to `retries` times, waiting `backoff` seconds before the first retry and doubling the
+    wait after each one. Other HTTP errors are raised straight away, and ResponseTooLarge is raised
+    when the response is bigger than `max_bytes`.
+    """
+    url=build_zbp_url(zips, year, base_url)
+    for attempt in range(retries + 1):
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                length=response.getheader('Content-Length')
+                if max_bytes is not None and length is not None and int(length) > max_bytes:
+                    raise ResponseTooLarge(length + ' bytes')
+                body=response.read() if max_bytes is None else response.read(max_bytes + 1)
+            if max_bytes is not None and len(body) > max_bytes:
+                raise ResponseTooLarge('more than ' + str(max_bytes) + ' bytes')
+            break
+        except urllib.error.HTTPError as err:
+            if (err.code < 500 and err.code != 429) or attempt == retries:
+                raise
+        except OSError:
+            #URLError and socket timeouts are both OSErrors
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+    print('Data for zip code ' + ', '.join(zips) + ' is being accessed')
+    #The Census API answers with an empty body (HTTP 204) when the zip codes have no data
+    if not body.strip():
+        return []
+    return json.loads(body)
+
+
+def fetch_chunk(zips, year, max_bytes=None, **kwargs):
+    """Request a chunk of zip codes together and return a dict of zip code -> response rows.
+
+    The combined response is split back into one response per zip code, each with the column
+    headers in row 0 (an empty list for a zip code with no data). When a request for more than one
+    zip code fails or its response is larger than `max_bytes`, the chunk is halved and each half is
+    requested on its own, down to single zip codes. Any extra keyword arguments are passed on to
+    fetch_rows.
+    """
+    try:
+        rows=fetch_rows(zips, year, max_bytes=max_bytes if len(zips) > 1 else None, **kwargs)
+    except (urllib.error.HTTPError, ResponseTooLarge, socket.timeout) as err:
+        if len(zips) == 1:
+            raise
+        print('Request for ' + str(len(zips)) + ' zip codes failed (' + str(err) + '), splitting it in half')
+        half=len(zips) // 2
+        rows_by_zip=fetch_chunk(zips[:half], year, max_bytes=max_bytes, **kwargs)
+        rows_by_zip.update(fetch_chunk(zips[half:], year, max_bytes=max_bytes, **kwargs))
+        return rows_by_zip
+    rows_by_zip={zipcode: [] for zipcode in zips}
+    if rows:
+        header=rows[0]
+        zip_column=header.index('zipcode')
+        for row in rows[1:]:
+            zip_rows=rows_by_zip[row[zip_column]]
+            if not zip_rows:
+                zip_rows.append(header)
+            zip_rows.append(row)
+    return rows_by_zip
+
+
+def output_folder(out_dir, folder):
+    """Return the path of a folder setting such as Cache_Dir inside `out_dir`, the setting itself when it is a full path, or None when it is None."""
+    return None if folder is None else os.path.join(out_dir, folder)
+
+
+@contextlib.contextmanager
+def _atomic_write(path, opener, mode, **kwargs):
+    """Open a file for the block of a with statement with opener(path, mode, **kwargs), and only put it at `path` once the block succeeds.
+
+    The file is written to a temporary file first, so an interrupted run never leaves a half written
+    file behind.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp=path + '.' + str(threading.get_ident()) + '.tmp'
+    try:
+        with opener(tmp, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ZBPCache:
+    """On-disk cache of Census API responses, stored as one gzip compressed JSON file per year and zip code.
+
+    A ZBP vintage never changes once it is published, so a cached response is served without any
+    network request. When the folder grows past `max_bytes` the least recently used responses are
+    removed. The number of hits and misses is counted for the end of run report. The responses of
+    each API server (`base_url`) are kept in their own folder, so those of a stand-in server are
+    never served in place of the Census API's.
+    """
+
+    def __init__(self, directory, max_bytes=None, base_url=Census_BaseURL):
+        self.directory=os.path.join(directory, hashlib.sha1(base_url.encode()).hexdigest()[:12])
+        self.max_bytes=max_bytes
+        self.hits=0
+        self.misses=0
+        self._lock=threading.Lock()
+
+    def _path(self, year, zipcode):
+        return os.path.join(self.directory, str(year), str(zipcode) + '.json.gz')
+
+    def get(self, year, zipcode):
+        """Return the cached response rows for a zip code and year, or None when they are not cached."""
+        path=self._path(year, zipcode)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                rows=json.load(f)
+            #Mark the file as recently used so it is evicted last
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses+=1
+            return None
+        with self._lock:
+            self.hits+=1
+        return rows
+
+    def put(self, year, zipcode, rows):
+        """Save the response rows for a zip code and year."""
+        with _atomic_write(self._path(year, zipcode), gzip.open, 'wt', encoding='utf-8') as f:
+            json.dump(rows, f, separators=(',', ':'))
+
+    def _files(self):
+        files=[]
+        for folder, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.json.gz'):
+                    path=os.path.join(folder, name)
+                    stat=os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove the least recently used responses until the cache fits in max_bytes. Returns the number removed."""
+        if self.max_bytes is None:
+            return 0
+        with self._lock:
+            files=sorted(self._files())
+            total=sum(size for _, size, _ in files)
+            removed=0
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total-=size
+                removed+=1
+        return removed
+
+    def invalidate(self, year=None, zips=None):
+        """Delete cached responses, either all of them or only those for one year and/or a list of zip codes.
+
+        Returns the number of responses deleted.
+        """
+        removed=0
+        with self._lock:
+            for _, _, path in self._files():
+                file_year=os.path.basename(os.path.dirname(path))
+                file_zip=os.path.basename(path)[:-len('.json.gz')]
+                if year is not None and file_year != str(year):
+                    continue
+                if zips is not None and file_zip not in zips:
+                    continue
+                os.remove(path)
+                removed+=1
+        return removed
+
+    def summary(self):
+        return 'Census API cache: ' + str(self.hits) + ' hits, ' + str(self.misses) + ' misses'
+
+
+def parse_years(years):
+    """Return the list of years described by DataYear: a single year, a range such as '2012-2016', or a list of years and ranges.
+
+    A year given more than once, such as in overlapping ranges, is only returned the first time.
+    """
+    if isinstance(years, str):
+        years=[years]
+    parsed=[]
+    for year in years:
+        year=str(year)
+        if '-' in year:
+            first, last=year.split('-')
+            if int(first) > int(last):
+                raise ValueError('The year range ' + year + ' ends before it starts')
+            parsed.extend(str(each) for each in range(int(first), int(last) + 1))
+        else:
+            parsed.append(year)
+    #A repeated year would be fetched and counted twice
+    return list(dict.fromkeys(parsed))
+
+
+def fetch_all_zips(zips, years, max_workers=Fetch_MaxWorkers, cache=None, zips_per_request=Fetch_ZipsPerRequest,
+                   max_bytes=Fetch_MaxResponseMB * 1024 * 1024, report=None, **kwargs):
+    """Fetch every zip code in `zips` for every year in `years` and return one dataframe of strings.
+
+    The NAICS columns are named NAICS and NAICS_TTL whatever the vintage of the year. The rows are
+    ordered by year and then in the order of `zips`. Pairs of year and zip code found in `cache`
+    are read from disk. The rest are packed into requests of `zips_per_request` zip codes and all
+    the requests for all the years are sent through a single pool, with at most `max_workers`
+    requests in flight. Each response is saved to the cache one zip code at a time. The cache
+    lookups and each request are recorded in `report`. Any extra keyword arguments are passed on
+    to fetch_rows.
+    """
+    report=report if report is not None else RunReport()
+    years=parse_years(years)
+    rows_by_key={}
+    tasks=[]
+    with report.stage('fetch: cache lookup', rows_in=len(zips) * len(years)) as result:
+        for year in years:
+            missing=[]
+            for zipcode in zips:
+                rows=cache.get(year, zipcode) if cache is not None else None
+                if rows is None:
+                    missing.append(zipcode)
+                else:
+                    rows_by_key[year, zipcode]=rows
+            tasks.extend((year, missing[i:i + zips_per_request]) for i in range(0, len(missing), zips_per_request))
+        result['rows_out']=len(rows_by_key)
+    if tasks:
+        def fetch(chunk, year):
+            #Record each request as a stage, with the zip codes requested in and the data rows received out
+            with report.stage('fetch: census api', detail=year + ' ' + ','.join(chunk), rows_in=len(chunk)) as result:
+                chunk_rows=fetch_chunk(chunk, year, max_bytes=max_bytes, **kwargs)
+                result['rows_out']=sum(max(len(rows) - 1, 0) for rows in chunk_rows.values())
+            return chunk_rows
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures=[pool.submit(fetch, chunk, year) for year, chunk in tasks]
+            for (year, _), future in zip(tasks, futures):
+                chunk_rows=future.result()
+                for zipcode, rows in chunk_rows.items():
+                    rows_by_key[year, zipcode]=rows
+                    if cache is not None:
+                        cache.put(year, zipcode, rows)
+        if cache is not None:
+            cache.evict()
+    #Every response of a year has the same column headers in row 0, so the data rows of each year are stacked into a single
+    #dataframe. The NAICS columns are named after the vintage of the year, so they are renamed before the years are stacked
+    frames=[]
+    with report.stage('fetch: build dataframe', rows_in=len(rows_by_key)) as result:
+        for year in years:
+            responses=[rows_by_key[year, zipcode] for zipcode in zips if rows_by_key[year, zipcode]]
+            if responses:
+                variable=naics_variable(year)
+                frames.append(pd.DataFrame([row for rows in responses for row in rows[1:]], columns=responses[0][0])
+                              .rename(columns={variable:'NAICS', variable + '_TTL':'NAICS_TTL'}))
+        if not frames:
+            raise NoDataError('The Census API has no data for any of the requested zip codes in ' + ', '.join(years))
+        df_AllZips=pd.concat(frames, ignore_index=True)
+        result['rows_out']=len(df_AllZips)
+    return df_AllZips
+
+
+def fetch(zips, years, cache=None, **kwargs):
+    """Fetch the ZBP data for every zip code and year and return it as df_AllZips, with the columns ordered and renamed.
+
+    Any extra keyword arguments are passed on to fetch_all_zips.
+    """
+    df_AllZips=fetch_all_zips(zips, years, cache=cache, **kwargs)
+
+    #Set the order of the columns
+    df_AllZips=df_AllZips[['zipcode','GEO_TTL','YEAR','NAICS','NAICS_TTL','ESTAB','EMPSZES','EMPSZES_TTL']]
+    #Rename Columns
+    return df_AllZips.rename(columns={'zipcode':'Zipcode','GEO_TTL':'GeoName','YEAR':'Year'
+                                      ,'NAICS_TTL':'Industry Name','ESTAB':'Establishments','EMPSZES':'Employment Size Class Code'
+                                      ,'EMPSZES_TTL':'Employment Size Class'})
+
+
+"""# Reading the ZBP Detail Files
+
+For national or multi-state studies, the same data can be read from the ZBP detail files Census publishes for each year instead of the API. A detail file has one row per zip code and NAICS code, with the number of establishments ('est') and a column with the number of establishments in each employment size class. The file is read in chunks, and only the rows of the requested zip codes and 6-digit NAICS codes are kept from each chunk. The size class columns are then turned into one row per size class, with the same columns as the API data.
+"""
+
+#EMPSZES code and title of the establishment count columns of the detail files. Older files name the 1 to 4 employees column n1_4
+Detail_SizeColumns={'est':('001','All establishments')
+                   ,'n<5':('212','Establishments with 1 to 4 employees')
+                   ,'n1_4':('212','Establishments with 1 to 4 employees')
+                   ,'n5_9':('220','Establishments with 5 to 9 employees')
+                   ,'n10_19':('230','Establishments with 10 to 19 employees')
+                   ,'n20_49':('241','Establishments with 20 to 49 employees')
+                   ,'n50_99':('242','Establishments with 50 to 99 employees')
+                   ,'n100_249':('251','Establishments with 100 to 249 employees')
+                   ,'n250_499':('252','Establishments with 250 to 499 employees')
+                   ,'n500_999':('254','Establishments with 500 to 999 employees')
+                   ,'n1000':('260','Establishments with 1,000 employees or more')}
+
+
+def detail_file_year(path):
+    """Return the year of a ZBP detail file from its name (zbp16detail.zip -> '2016')."""
+    name=os.path.basename(path).lower()
+    if not (name.startswith('zbp') and name[3:5].isdigit() and name[5:].startswith('detail')):
+        raise ValueError('Can\'t tell the year of ' + path + ', ZBP detail files are named like zbp16detail.zip')
+    return '20' + name[3:5]
+
+
+def read_naics_titles(path):
+    """Read a file of NAICS codes and titles (the first two columns, like the Census naics2012.txt file) and return the titles by code."""
+    titles=pd.read_csv(path, dtype=str, encoding='latin-1').iloc[:, :2].dropna()
+    return pd.Series(titles.iloc[:, 1].str.strip().to_numpy(), index=titles.iloc[:, 0].str.strip()).to_dict()
+
+
+def read_zbp_detail(path, zips, year=None, naics_titles=None, chunk_rows=Detail_ChunkRows, report=None):
+    """Read the rows of `zips` (every zip code when None) from a ZBP detail file and return them in the df_AllZips layout, as strings.
+
+    The file may be zipped. Only the 6-digit NAICS codes are kept, and size classes with no
+    establishments are left out. `year` defaults to the year in the file name, and `naics_titles`
+    is a dict of NAICS code -> title (the code is used as the title when it is missing). Each chunk
+    read is recorded in `report`.
+    """
+    report=report if report is not None else RunReport()
+    year=year if year is not None else detail_file_year(path)
+    zips=set(zips) if zips is not None else None
+    #Column names are lower case in some years and upper case in others
+    columns={column.lower(): column for column in pd.read_csv(path, nrows=0, encoding='latin-1').columns}
+    size_columns=[column for column in Detail_SizeColumns if column in columns]
+    usecols=[columns[column] for column in ['zip','name','naics'] + size_columns if column in columns]
+
+    parts=[]
+    for chunk in pd.read_csv(path, usecols=usecols, dtype=str, chunksize=chunk_rows, encoding='latin-1'):
+        with report.stage('read: detail file', detail=year, rows_in=len(chunk)) as result:
+            chunk.columns=[column.lower() for column in chunk.columns]
+            zipcode=chunk['zip'].str.strip().str.zfill(5)
+            naics=chunk['naics'].str.strip()
+            keep=naics.str.fullmatch(r'\d{6}')
+            if zips is not None:
+                keep=keep & zipcode.isin(zips)
+            parts.append(chunk[keep].assign(zip=zipcode[keep], naics=naics[keep]))
+            result['rows_out']=int(keep.sum())
+    detail=pd.concat(parts, ignore_index=True)
+    if detail.empty:
+        raise NoDataError(path + ' has no data for any of the requested zip codes')
+
+    #One row per zip code, NAICS code and size class with establishments
+    names=['name'] if 'name' in detail.columns else []
+    df_AllZips=detail.melt(id_vars=['zip','naics'] + names, value_vars=size_columns, var_name='column', value_name='Establishments')
+    Establishments=pd.to_numeric(df_AllZips['Establishments'], errors='coerce').fillna(0).astype('int64')
+    df_AllZips=df_AllZips[Establishments.to_numpy() > 0].assign(Establishments=Establishments[Establishments > 0].astype(str))
+
+    GeoName='ZIP ' + df_AllZips['zip']
+    if names:
+        GeoName=GeoName + (' (' + df_AllZips['name'].str.strip() + ')').fillna('')
+    IndustryName=df_AllZips['naics'].map(naics_titles or {}).fillna(df_AllZips['naics'])
+    df_AllZips=pd.DataFrame({'Zipcode':df_AllZips['zip'], 'GeoName':GeoName, 'Year':year, 'NAICS':df_AllZips['naics']
+                            ,'Industry Name':IndustryName, 'Establishments':df_AllZips['Establishments']
+                            ,'Employment Size Class Code':df_AllZips['column'].map(lambda column: Detail_SizeColumns[column][0])
+                            ,'Employment Size Class':df_AllZips['column'].map(lambda column: Detail_SizeColumns[column][1])})
+    return df_AllZips.sort_values(by=['Zipcode','NAICS','Employment Size Class Code'], ignore_index=True)
+
+
+def read_detail_files(zips, years, detail_files, naics_titles=None, report=None, **kwargs):
+    """Read the rows of `zips` for every year in `years` from the ZBP detail file of that year, and return one df_AllZips.
+
+    `detail_files` is a list of detail file paths, each matched to its year by its name, and
+    `naics_titles` the path of a NAICS titles file. Any extra keyword arguments are passed on to
+    read_zbp_detail.
+    """
+    files={detail_file_year(path): path for path in detail_files}
+    missing=[year for year in parse_years(years) if year not in files]
+    if missing:
+        raise ValueError('No ZBP detail file for ' + ', '.join(missing))
+    titles=read_naics_titles(naics_titles) if naics_titles is not None else None
+    return pd.concat([read_zbp_detail(files[year], zips, year, titles, report=report, **kwargs) for year in parse_years(years)]
+                     , ignore_index=True)
 
 
 """# Create Data Frames with Additional Attributes
@@ -114,377 +656,922 @@ data={'Employment Size Class Code':['212','220','230','241','242','251','252','2
 #Create a new dataframe using the data above
 midpoint_df=pd.DataFrame(data)
 
+#The lowest and highest number of employees of each class, used by the uncertainty mode. The 1,000 or more class has no highest number (NaN)
+sizerange_df=pd.DataFrame({'Employment Size Class Code':['212','220','230','241','242','251','252','254','260']
+                          ,'Lowest':[1,5,10,20,50,100,250,500,1000]
+                          ,'Highest':[4,9,19,49,99,249,499,999,np.nan]})
+
 
 """The second table provides us with the list of NAICS codes that are part of the marine economy as defined by the NOAA Office for Coastal Management. The NAICS codes are grouped into marine sectors for ease of reporting. The crosswalk of NAICS codes th marine sectors can be found here:
 https://coast.noaa.gov/data/digitalcoast/pdf/enow-crosswalk-table.pdf
-"""
-
-#Create the data (columns, values)
-data={'NAICS':['112511','112512','112519','114111','114112','114119','211111','211112','212321','212322','213111','213112','237990','311710','334511','336611','336612',
-      '339920','441222','445220','483111','483112','483113','483114','487210','487990','488310','488320','488330','488390','493110','493120','493130','532292',
-      '541360','611620','712130','712190','713930','713990','721110','721191','721211','722511','722513','722514','722515'],
-      'Marine Sector':['Living Resources','Living Resources','Living Resources','Living Resources','Living Resources','Living Resources','Offshore Mineral Resources','Offshore Mineral Resources'
-      ,'Offshore Mineral Resources','Offshore Mineral Resources','Offshore Mineral Resources','Offshore Mineral Resources','Marine Construction','Living Resources','Marine Transportation'
-      ,'Ship and Boat Building','Ship and Boat Building','Tourism and Recreation','Tourism and Recreation','Living Resources','Marine Transportation','Marine Transportation','Marine Transportation'
-      ,'Marine Transportation','Tourism and Recreation','Tourism and Recreation','Marine Transportation','Marine Transportation','Marine Transportation','Marine Transportation','Marine Transportation'
-      ,'Marine Transportation','Marine Transportation','Tourism and Recreation','Offshore Mineral Resources','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation'
-      ,'Tourism and Recreation','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation','Tourism and Recreation']}
 
-#Create a new dataframe using the data above
-marinesector_df=pd.DataFrame(data)
-
-
-"""# Filtering the data
-
-The next  steps will be working with the data from the Census API. First, we want to remove the 'All Establishments' class (EMPSZES code 001). This class just shows the total number of establishments for a NAICS code in a zip code across all employment ranges. This class is not used for the analysis.
+NAICS codes are revised every five years, so there is one crosswalk file per NAICS vintage in the crosswalks folder (enow_naics2012.csv, enow_naics2017.csv and enow_naics2022.csv). They are loaded into a single table, with the vintage of each row, and the rows of each data year are matched with the crosswalk of its vintage. To add a marine industry, add it to the file of each vintage it belongs to.
 """
 
-#This is where we remove the 'All Establishments' class so we don't double count
-RemoveAllEstab=df_AllZips[df_AllZips['Employment Size Class Code']!='001']
+def load_crosswalks(directory=Crosswalk_Dir, vintages=NAICS_Vintages):
+    """Load the crosswalk file of each NAICS vintage and return them as one dataframe (NAICS Vintage, NAICS, Marine Sector)."""
+    crosswalks=[pd.read_csv(os.path.join(directory, 'enow_naics' + vintage + '.csv'), dtype=str).assign(**{'NAICS Vintage':vintage})
+                for vintage in vintages]
+    return pd.concat(crosswalks, ignore_index=True)[['NAICS Vintage','NAICS','Marine Sector']]
 
-#Only keep rows where the values in the NAICS field have a length of 6 characters
-RemoveNAICS=RemoveAllEstab[RemoveAllEstab['NAICS'].str.len() == 6]
+#Create a new dataframe from the crosswalk files
+marinesector_df=load_crosswalks()
 
-"""Next, we want to remove any rows where the number of establishments are 0. These are no data points, and removing them will cut down on the amount of data to be analyzed."""
 
-#This is where we filter to only keep rows where establishments are not equal to 0. This cuts down the extraneous data.
-TotalEconomy_df=RemoveNAICS[RemoveNAICS['Establishments']!='0']
+"""# Filtering the data
 
-"""# Create Total Economy Output
+The next  steps will be working with the data from the Census API. Every value from the API is text, so before filtering we store the codes and names as categoricals (each distinct value is stored once and every row holds a small integer code) and the establishment counts as integers. This cuts the memory used by large extracts several-fold, and lets the filters and lookups below work on integer arrays instead of comparing strings row by row.
 
-Now that we have cleaned up the input data, we are ready to put together the outputs. First, we will create an output for the total economy, which includes everything in each of the zip codes. This output will be used for comparison purposes. The first step is to join the midpoints from the dataframe we created earlier to the API dataframe.
+First, we want to remove the 'All Establishments' class (EMPSZES code 001). This class just shows the total number of establishments for a NAICS code in a zip code across all employment ranges. This class is not used for the analysis. We also only keep the 6-digit NAICS codes, and remove any rows where the number of establishments are 0. These are no data points, and removing them will cut down on the amount of data to be analyzed. The three filters are combined into a single mask.
 """
 
-#Here is where we join the midpoints to the total economy data frame, and then set the ESTAB and Midpoint columns to be numeric values
-TotalEcon=TotalEconomy_df.join(midpoint_df.set_index('Employment Size Class Code'),on='Employment Size Class Code')
+def clean(df_AllZips, midpoint_df=midpoint_df, report=None):
+    """Convert df_AllZips to categoricals and integer counts, and keep the rows used in the analysis (TotalEconomy_df)."""
+    report=report if report is not None else RunReport()
+    with report.stage('clean: categoricals', rows_in=len(df_AllZips)) as result:
+        #The employment size class codes use a fixed list of categories: the 'All Establishments' class (001) first, followed by the classes in midpoint_df
+        SizeClassCodes=['001'] + list(midpoint_df['Employment Size Class Code'])
+        df_AllZips=df_AllZips.astype({'Zipcode':'category','GeoName':'category','Year':'category','NAICS':'category'
+                                     ,'Industry Name':'category','Employment Size Class':'category'
+                                     ,'Employment Size Class Code':pd.CategoricalDtype(SizeClassCodes)})
+        df_AllZips['Establishments']=pd.to_numeric(df_AllZips['Establishments']).astype('int32')
+        result['rows_out']=len(df_AllZips)
+
+    with report.stage('clean: filters', rows_in=len(df_AllZips)) as result:
+        #Integer code of each row's size class. Code 0 is the 'All Establishments' class, which we remove so we don't double count
+        SizeClass=df_AllZips['Employment Size Class Code'].cat.codes.to_numpy()
+
+        #Check the length of each distinct NAICS code once, then look the result up for every row by its integer code.
+        #The extra entry at the end is used by missing values, which have the code -1
+        NAICSCode=df_AllZips['NAICS'].cat.codes.to_numpy()
+        IsNAICS6=np.append(df_AllZips['NAICS'].cat.categories.str.len() == 6, False)[NAICSCode]
+
+        #Only keep rows in a size class, with a 6-digit NAICS code and with establishments not equal to 0
+        TotalEconomy_df=df_AllZips[(SizeClass != 0) & IsNAICS6 & (df_AllZips['Establishments'].to_numpy() != 0)]
+        result['rows_out']=len(TotalEconomy_df)
+    return TotalEconomy_df
+
+"""# Create Total Economy and Marine Economy Outputs
+
+Now that we have cleaned up the input data, we are ready to put together the outputs. First, we will create an output for the total economy, which includes everything in each of the zip codes. This output will be used for comparison purposes. The first step is to add the midpoints from the dataframe we created earlier to the API dataframe. Because the size class codes are in the same order as midpoint_df, each row's midpoint is found by indexing an array with its size class code. Next, we will create a new colum called 'EmploymentEstimate', and calculate the value by multiplying the number of establishments with the midpoint.
+
+The next step is to take the total economy and filter it down to the industries that are marine dependent, and label each of them with its marine sector. Both come from marinesector_df in a single pass. The crosswalk is compiled into a small table with one row per NAICS vintage and one column per distinct NAICS code in the data, holding the marine sector of the code in that vintage. Every row is then matched to its sector by indexing that table with the vintage of its year and its NAICS integer code.
+"""
 
-#Set the Estab and Midpoint columns to be numeric so we can do math with the values
-TotalEcon[['Establishments','Midpoint']]=TotalEcon[['Establishments','Midpoint']].apply(pd.to_numeric)
+def marine_sector_codes(naics, years, marinesector_df=marinesector_df):
+    """Return the integer marine sector code of each row (-1 when it is not marine), and the sector names the codes refer to.
 
-"""Next, we will create a new colum called 'EmploymentEstimate', and calculate the value by multiplying the number of establishments with the midpoint."""
+    `naics` and `years` are the categorical NAICS and Year columns of the rows. Each row is looked
+    up in the crosswalk of the NAICS vintage of its year.
+    """
+    #The marine sector names, and the NAICS vintages of the crosswalk
+    MarineSectorNames=pd.Index(sorted(marinesector_df['Marine Sector'].unique()))
+    Vintages=pd.Index(sorted(marinesector_df['NAICS Vintage'].unique()))
 
-#Create the formula
-CalcEmp=TotalEcon.Establishments * TotalEcon.Midpoint
+    #Sector code of each distinct NAICS code in the data in each vintage (-1 when it is not marine), with a column of -1 at the end for
+    #missing NAICS codes and a row of -1 at the end for years without a crosswalk
+    SectorLookup=np.full((len(Vintages) + 1, len(naics.cat.categories) + 1), -1)
+    for row, (vintage, crosswalk) in enumerate(marinesector_df.groupby(by='NAICS Vintage', sort=True)):
+        SectorOfNAICS=pd.Series(MarineSectorNames.get_indexer(crosswalk['Marine Sector']), index=crosswalk['NAICS'])
+        SectorLookup[row, :-1]=SectorOfNAICS.reindex(naics.cat.categories, fill_value=-1).to_numpy()
 
-#Apply the formula to the new column 'EmploymentEstimate'
-TotalEcon['Employment Estimate']=CalcEmp
+    #Crosswalk row of each distinct year in the data, plus the row of -1 for missing years
+    YearVintage=np.append(Vintages.get_indexer([naics_vintage(year) for year in years.cat.categories]), -1)
+    return SectorLookup[YearVintage[years.cat.codes.to_numpy()], naics.cat.codes.to_numpy()], MarineSectorNames
 
-"""# Create Marine Economy Output
 
-The next step is to take the total economy and filter it down to the industries that are marine dependent.
-"""
-print('Creating Marine Economy table')
+def add_marine_sector(df, marinesector_df=marinesector_df):
+    """Keep the rows of `df` with a marine NAICS code and add their 'Marine Sector' titles."""
+    SectorCode, MarineSectorNames=marine_sector_codes(df['NAICS'], df['Year'], marinesector_df)
+    IsMarine=SectorCode >= 0
+    return df[IsMarine].assign(**{'Marine Sector':pd.Categorical.from_codes(SectorCode[IsMarine], categories=MarineSectorNames)})
 
-#Filter the total economy by a list of NAICS codes, create the output into a new data frame
-MarineEconomy_df=TotalEcon[TotalEcon["NAICS"].isin(['112511','112512','112519','114111','114112','114119','211111','211112','212321','212322','213111'
-                                                   ,'213112','237990','311710','334511','336611','336612','339920','441222','445220','483111','483112'
-                                                   ,'483113','483114','487210','487990','488310','488320','488330','488390','493110','493120','493130'
-                                                   ,'532292','541360','611620','712130','712190','713930','713990','721110','721191','721211','722511'
-                                                   ,'722513','722514','722515'])]
 
-"""After creating a new dataframe with just the marine-dependent establishments, we will join in the marine sector titles"""
+def enrich(TotalEconomy_df, midpoint_df=midpoint_df, marinesector_df=marinesector_df, report=None):
+    """Add the midpoints and employment estimates to the cleaned data, and return the TotalEcon and Marine_df dataframes."""
+    report=report if report is not None else RunReport()
+    with report.stage('enrich: midpoint join', rows_in=len(TotalEconomy_df)) as result:
+        #Midpoint of each size class code: NaN for the 'All Establishments' class, the midpoints in midpoint_df order, and NaN for missing values
+        MidpointLookup=np.concatenate([[np.nan], pd.to_numeric(midpoint_df['Midpoint']).to_numpy(), [np.nan]])
+        TotalEcon=TotalEconomy_df.assign(Midpoint=MidpointLookup[TotalEconomy_df['Employment Size Class Code'].cat.codes.to_numpy()])
 
-#Join the marine_df dataframe to the marinesector_df dataframe based on the NAICS2012 column values
-Marine_df=MarineEconomy_df.join(marinesector_df.set_index('NAICS'),on='NAICS')
+        #Apply the formula to the new column 'EmploymentEstimate'
+        TotalEcon['Employment Estimate']=TotalEcon['Establishments'].to_numpy() * TotalEcon['Midpoint'].to_numpy()
+        result['rows_out']=len(TotalEcon)
 
-Marine_df.style.hide_index()
+    with report.stage('enrich: marine filter and join', rows_in=len(TotalEcon)) as result:
+        Marine_df=add_marine_sector(TotalEcon, marinesector_df)
+        result['rows_out']=len(Marine_df)
+    return TotalEcon, Marine_df
 
 """# Data Analysis
 
 After creating the base data outputs, we will do some initial analysis.First, we will create an output for the total number of establishments and jobs within our list of zip codes.
-"""
-print('Creating analysis tables')
-#Create the dataframe 'TotalEconAnalysis', group the data by the geography attributes, and sum by 'ESTAB' and 'EmploymentEstimate'
-TotalEconAnalysis=TotalEcon.groupby(by=['Zipcode','GeoName','Year'])['Establishments','Employment Estimate'].sum().reset_index()
-
-#Create a total for the entire study area
-TotalStudyArea_df=TotalEcon.groupby(by=['Year'])['Establishments','Employment Estimate'].sum().reset_index()
-
-#Add back in the Zipcode and GeoName columns
-TotalStudyArea_df=TotalStudyArea_df.assign(Zipcode='XXXXX').assign(GeoName='Total for Study Area').assign(Year=DataYear)
-TotalStudyArea_df=TotalStudyArea_df[['Zipcode','GeoName','Year','Establishments','Employment Estimate']]
-
-#Append TotalStudyArea_df to TotalEconAnalysis
-TotalEconAnalysis=TotalEconAnalysis.append(TotalStudyArea_df, ignore_index=True)
-TotalEconAnalysis.Zipcode.apply(str)
 
-#TotalEconAnalysis
-
-"""Next, we will create a series of outputs analyzing the marine economy data. The outputs will include:
+Next, we will create a series of outputs analyzing the marine economy data. The outputs will include:
 
 
 *   Marine Economy of  Study Area by Sector
 *   Marine Economy of each Zip Code by Sector
 *   Marine Economy of Study Area by Industry
 *   Marine Economy of each Zip Code by Industry
-"""
-
-#Create a total for the entire study area
-MarineStudyArea=Marine_df.groupby(by=['Year'])['Establishments','Employment Estimate'].sum().reset_index()
 
-#Add back in the Zipcode and GeoName columns
-MarineStudyArea=MarineStudyArea.assign(Zipcode='XXXXX').assign(GeoName='Total for Study Area').assign(Year=DataYear)
-MarineStudyArea=MarineStudyArea[['Zipcode','GeoName','Year','Establishments','Employment Estimate']]
+When more than one year of data is requested, two more outputs show how the study area changed from each year to the next year in the panel:
 
 
-#Create a total for the entire study area
-MarineStudyAreaZip=Marine_df.groupby(by=['Zipcode','GeoName','Year'])['Establishments','Employment Estimate'].sum().reset_index()
+*   Year-over-Year Change of the Total and Marine Economy of the Study Area
+*   Year-over-Year Change of the Marine Economy by Sector
 
+All of the analysis tables are sums of establishments and employment over different groupings of the same rows. Instead of scanning the data once per table, the data is grouped once at the finest grouping needed and every table is rolled up from that. The tables are only rolled up when they are asked for, so a program that only needs Table 1 and Table 2 doesn't pay for the others.
+"""
 
-#Append TotalStudyArea_df to TotalEconAnalysis
-MarineStudyAreaZip=MarineStudyAreaZip.append(MarineStudyArea, ignore_index=True)
-MarineStudyAreaZip.rename(columns={'Establishments':'Marine Establishments','Employment Estimate':'Marine Employment'}, inplace=True)
-MarineStudyAreaZip.Zipcode.apply(str)
-
-
-#Here is where we will join the total economy by zip code and marine economy by zip code tables
-TotalEconAnalysis_df=TotalEconAnalysis.merge(MarineStudyAreaZip, on=('Zipcode','GeoName','Year'))
-TotalEconAnalysis_df
-
-#Create a new column 'Percent Marine Employment', calculate the values
-TotalEconAnalysis_df['Percent Marine Employment']=(TotalEconAnalysis_df['Marine Employment']/TotalEconAnalysis_df['Employment Estimate'])*100
-TotalMarineCompare_df=TotalEconAnalysis_df.round(1)
-
-#Marine economy by sector with sums of establishments and employment
-MarineSectors=Marine_df.groupby(by=['Year','Marine Sector'])['Establishments','Employment Estimate'].sum().reset_index()
-MarineSectors['Average Employment']=MarineSectors['Employment Estimate']/MarineSectors['Establishments']
-MarineSectors_df=MarineSectors.round(1)
-
-#Creates a table title for future use in html page
-MarineSectorsAnalysis_df=(MarineSectors_df.style.set_caption('Marine Economy by Sector'))
-
-#Marine economy by zip code by sextor with sums of establishments and employment
-MarineSectorsZip=Marine_df.groupby(by=['Zipcode','GeoName','Year','Marine Sector'])['Establishments','Employment Estimate'].sum().reset_index()
-MarineSectorsZip['Average Employment']=MarineSectorsZip['Employment Estimate']/MarineSectorsZip['Establishments']
-MarineSectorsZip_df=MarineSectorsZip.round(1)
-
-#Creates a table title for future use in html page
-MarineSectorsZipAnalysis_df=(MarineSectorsZip_df.style.set_caption('Marine Economy by Zip Code and by Sector'))
-
-#Marine economy by industry with sums of establishments and employment
-MarineIndustries=Marine_df.groupby(by=['Year','NAICS','Industry Name','Marine Sector'])['Establishments','Employment Estimate'].sum().reset_index()
-MarineIndustries['Average Employment']=MarineIndustries['Employment Estimate']/MarineIndustries['Establishments']
-MarineIndustries_df=MarineIndustries.round(1)
-
-#Creates a table title for future use in html page
-MarineIndustriesAnalysis_df=(MarineIndustries_df.style.set_caption('Marine Economy by Industry'))
-
-#Marine economy by zip code by industry with sums of establishments and employment
-MarineIndustriesZip=Marine_df.groupby(by=['Zipcode','GeoName','Year','NAICS','Industry Name','Marine Sector'])['Establishments','Employment Estimate'].sum().reset_index()
-MarineIndustriesZip['Average Employment']=MarineIndustriesZip['Employment Estimate']/MarineIndustriesZip['Establishments']
-MarineIndustriesZip_df=MarineIndustriesZip.round(1)
+def grouping_sets(df, sets, values=('Establishments','Employment Estimate')):
+    """Sum `values` for each grouping set in `sets`, like GROUP BY GROUPING SETS in SQL.
+
+    `df` is scanned once and grouped by every column used in any of the sets (the finest grain),
+    then each grouping set is rolled up from that much smaller result. Returns one dataframe per
+    grouping set, with the set's columns followed by `values`, sorted by the set's columns.
+    """
+    keys=[]
+    for grouping in sets:
+        keys.extend(column for column in grouping if column not in keys)
+    finest=df.groupby(by=keys, observed=True, sort=False)[list(values)].sum()
+    return [finest.groupby(level=list(grouping), observed=True).sum().reset_index() for grouping in sets]
+
+
+def aggregate(TotalEcon, marinesector_df=marinesector_df, report=None, names=None):
+    """Create the analysis tables from TotalEcon and return them by sheet name ('Table1_Analysis' to 'Table7_Analysis').
+
+    Only the tables in `names` are created when it is given, along with the roll-ups they need. The
+    year-over-year tables (Table6_Analysis and Table7_Analysis) are only created when TotalEcon
+    holds more than one year. Each grouping and table is recorded in `report`.
+    """
+    report=report if report is not None else RunReport()
+    if names is not None and all(name in TABLES and 'build' not in TABLES[name] for name in names):
+        #Only the data tables are asked for
+        return {}
+    #Sum the establishments and employment of each zip code, year and NAICS code. This is the only pass over the full TotalEcon table,
+    #every analysis table is rolled up from this result
+    with report.stage('aggregate', detail='zip code, year and industry totals', rows_in=len(TotalEcon)) as result:
+        EconByIndustry=grouping_sets(TotalEcon, [['Zipcode','GeoName','Year','NAICS','Industry Name']])[0]
+        result['rows_out']=len(EconByIndustry)
+    return analysis_tables(EconByIndustry, marinesector_df, report=report, names=names)
+
+
+def analysis_tables(EconByIndustry, marinesector_df=marinesector_df, report=None, names=None):
+    """Roll the analysis tables up from the establishments and employment of each zip code, year and NAICS code.
+
+    `EconByIndustry` has the Zipcode, GeoName, Year, NAICS and Industry Name columns, as
+    categoricals, and the Establishments and Employment Estimate sums. Returns the tables like
+    aggregate(), in the order of TABLES.
+    """
+    for name in names or []:
+        if name not in TABLES:
+            raise ValueError('Unknown table ' + name + ', the tables are ' + ', '.join(TABLES))
+    Tables=AnalysisTables(EconByIndustry, marinesector_df, report)
+    MultiYear=EconByIndustry['Year'].nunique() > 1
+    return {name: Tables[name] for name, layout in TABLES.items()
+            if 'build' in layout and (names is None or name in names) and (MultiYear or not layout.get('multi_year'))}
+
+
+class AnalysisTables:
+    """The analysis tables of EconByIndustry by name, each one created the first time it is asked for.
+
+    The roll-ups a table is made from are kept for the other tables that use them, and the roll-ups
+    of the tables that are never asked for are never made. Each roll-up and table is recorded in
+    `report`.
+    """
+
+    def __init__(self, EconByIndustry, marinesector_df=marinesector_df, report=None):
+        self.EconByIndustry=EconByIndustry
+        self.marinesector_df=marinesector_df
+        self.report=report if report is not None else RunReport()
+        self._marine={}
+        self._tables={}
+
+    def __getitem__(self, name):
+        if name not in self._tables:
+            with self.report.stage('aggregate', detail=name) as result:
+                self._tables[name]=TABLES[name]['build'](self, TABLES[name]['keys'])
+                result['rows_out']=len(self._tables[name])
+        return self._tables[name]
+
+    @functools.cached_property
+    def total_economy(self):
+        """The establishments and employment of each zip code and year, followed by the study area total of each year (TotalEconAnalysis)."""
+        with self.report.stage('aggregate', detail='total economy roll-ups', rows_in=len(self.EconByIndustry)) as result:
+            #Create the dataframe 'TotalEconAnalysis' with the totals of each zip code, and a total for the entire study area
+            TotalEconAnalysis, TotalStudyArea_df=grouping_sets(self.EconByIndustry, [['Zipcode','GeoName','Year'], ['Year']])
+
+            #Add back in the Zipcode and GeoName columns
+            TotalStudyArea_df=TotalStudyArea_df.assign(Zipcode='XXXXX').assign(GeoName='Total for Study Area')
+            TotalStudyArea_df=TotalStudyArea_df[['Zipcode','GeoName','Year','Establishments','Employment Estimate']]
+
+            #Append TotalStudyArea_df to TotalEconAnalysis
+            TotalEconAnalysis=pd.concat([TotalEconAnalysis, TotalStudyArea_df], ignore_index=True)
+            result['rows_out']=len(TotalEconAnalysis)
+        return TotalEconAnalysis
+
+    @functools.cached_property
+    def marine_by_industry(self):
+        """The marine NAICS codes of EconByIndustry, labelled with their marine sector through the same lookup used for Marine_df."""
+        with self.report.stage('aggregate', detail='marine industries', rows_in=len(self.EconByIndustry)) as result:
+            MarineByIndustry=add_marine_sector(self.EconByIndustry, self.marinesector_df)
+            result['rows_out']=len(MarineByIndustry)
+        return MarineByIndustry
+
+    def marine(self, keys):
+        """The marine establishments and employment summed by the columns in `keys`."""
+        if tuple(keys) not in self._marine:
+            with self.report.stage('aggregate', detail='marine economy by ' + ', '.join(keys), rows_in=len(self.marine_by_industry)) as result:
+                self._marine[tuple(keys)]=grouping_sets(self.marine_by_industry, [list(keys)])[0]
+                result['rows_out']=len(self._marine[tuple(keys)])
+        return self._marine[tuple(keys)]
+
+
+def economy_comparison(Tables, keys):
+    """Table 1: the total and marine economy of each zip code and of the study area."""
+    #Add back in the Zipcode and GeoName columns to the study area total
+    MarineStudyArea=Tables.marine(['Year']).assign(Zipcode='XXXXX').assign(GeoName='Total for Study Area')
+    MarineStudyArea=MarineStudyArea[['Zipcode','GeoName','Year','Establishments','Employment Estimate']]
+
+    #Append MarineStudyArea to MarineStudyAreaZip
+    MarineStudyAreaZip=pd.concat([Tables.marine(keys), MarineStudyArea], ignore_index=True)
+    MarineStudyAreaZip=MarineStudyAreaZip.rename(columns={'Establishments':'Marine Establishments','Employment Estimate':'Marine Employment'})
+
+    #Here is where we will join the total economy by zip code and marine economy by zip code tables
+    TotalEconAnalysis_df=Tables.total_economy.merge(MarineStudyAreaZip, on=keys)
+
+    #Create a new column 'Percent Marine Employment', calculate the values
+    TotalEconAnalysis_df['Percent Marine Employment']=(TotalEconAnalysis_df['Marine Employment']/TotalEconAnalysis_df['Employment Estimate'])*100
+    return TotalEconAnalysis_df.round(1)
+
+
+def marine_economy(Tables, keys):
+    """Tables 2 to 5: the marine economy summed by `keys`, with the average employment per establishment."""
+    table=Tables.marine(keys).copy()
+    table['Average Employment']=table['Employment Estimate']/table['Establishments']
+    return table.round(1)
+
+
+def percent_change(current, previous):
+    """Percent change from `previous` to `current`, left empty where `previous` is 0."""
+    return (current/previous.where(previous != 0)-1)*100
+
+
+def study_area_growth(Tables, keys):
+    """Table 6: the study area totals by year, each compared with the year before it."""
+    TotalStudyArea=Tables.total_economy.loc[Tables.total_economy['Zipcode']=='XXXXX', ['Year','Establishments','Employment Estimate']]
+    MarineStudyArea=Tables.marine(keys).rename(columns={'Establishments':'Marine Establishments','Employment Estimate':'Marine Employment'})
+    #Years without any marine establishments are kept, with no marine economy, so each year is compared with the year before it
+    StudyAreaGrowth=TotalStudyArea.merge(MarineStudyArea, on=keys, how='left').fillna({'Marine Establishments':0,'Marine Employment':0})
+    StudyAreaGrowth=StudyAreaGrowth.astype({'Marine Establishments':MarineStudyArea['Marine Establishments'].dtype})
+    StudyAreaGrowth=StudyAreaGrowth.sort_values(by=keys).reset_index(drop=True)
+    StudyAreaGrowth['Employment Change (%)']=percent_change(StudyAreaGrowth['Employment Estimate'], StudyAreaGrowth['Employment Estimate'].shift())
+    StudyAreaGrowth['Marine Employment Change (%)']=percent_change(StudyAreaGrowth['Marine Employment'], StudyAreaGrowth['Marine Employment'].shift())
+    return StudyAreaGrowth.round(1)
+
+
+def sector_growth(Tables, keys):
+    """Table 7: the marine sectors by year, each compared with the same sector in the year before."""
+    MarineBySector=Tables.marine(['Year','Marine Sector'])
+    #Every sector gets a row for every year of the study area, with no establishments in the years it is missing from, so each year
+    #is compared with the year before it
+    Grid=MarineBySector[['Marine Sector']].drop_duplicates().merge(Tables.total_economy[['Year']].drop_duplicates(), how='cross')
+    SectorGrowth=Grid.merge(MarineBySector, on=keys, how='left').fillna({'Establishments':0,'Employment Estimate':0})
+    SectorGrowth=SectorGrowth.astype({'Establishments':MarineBySector['Establishments'].dtype})
+    SectorGrowth=SectorGrowth[['Marine Sector','Year','Establishments','Employment Estimate']].sort_values(by=keys).reset_index(drop=True)
+    PreviousYear=SectorGrowth.groupby(by=['Marine Sector'], observed=True)[['Establishments','Employment Estimate']].shift()
+    SectorGrowth['Establishments Change (%)']=percent_change(SectorGrowth['Establishments'], PreviousYear['Establishments'])
+    SectorGrowth['Employment Change (%)']=percent_change(SectorGrowth['Employment Estimate'], PreviousYear['Employment Estimate'])
+    return SectorGrowth.round(1)
+
+
+"""Every output table is declared once in TABLES, in the order of the Excel tabs. The analysis tables have the function that creates them from an AnalysisTables ('build'), the columns they are grouped by ('keys'), and the layout of their Excel tab: the title, the cells the title is merged across and the width of each range of columns. The year-over-year tables are only created for a multi-year panel ('multi_year'). The TotalEconomy_Data and MarineSectors_Data tables have no title, and are streamed into plain tabs.
+"""
 
-#Creates a table title for future use in html page
-MarineIndustriesZipAnalysis_df=(MarineIndustriesZip_df.style.set_caption('Marine Economy by Industry'))
+TABLES={'Table1_Analysis':{'build':economy_comparison, 'keys':['Zipcode','GeoName','Year']
+                          ,'title':'Table 1 - Comparison of Total Economy and Marine Economy', 'title_cells':'A1:H1'
+                          ,'widths':[('A:A',8), ('B:B',20), ('C:C',5), ('D:H',15)]}
+       ,'Table2_Analysis':{'build':marine_economy, 'keys':['Year','Marine Sector']
+                          ,'title':'Table 2 - Marine Economy by Sector', 'title_cells':'A1:E1'
+                          ,'widths':[('A:A',5), ('B:B',25), ('C:E',15)]}
+       ,'Table3_Analysis':{'build':marine_economy, 'keys':['Year','NAICS','Industry Name','Marine Sector']
+                          ,'title':'Marine Economy by Industry', 'title_cells':'A1:G1'
+                          ,'widths':[('A:A',5), ('B:B',7), ('C:C',45), ('D:D',26), ('E:G',15)]}
+       ,'Table4_Analysis':{'build':marine_economy, 'keys':['Zipcode','GeoName','Year','Marine Sector']
+                          ,'title':'Marine Economy by Zip Code by Sector', 'title_cells':'A1:G1'
+                          ,'widths':[('A:A',8), ('B:B',25), ('C:C',5), ('D:D',26), ('E:G',15)]}
+       ,'Table5_Analysis':{'build':marine_economy, 'keys':['Zipcode','GeoName','Year','NAICS','Industry Name','Marine Sector']
+                          ,'title':'Marine Economy by Zip Code by Industry', 'title_cells':'A1:I1'
+                          ,'widths':[('A:A',8), ('B:AB',20), ('C:C',5), ('D:D',7), ('E:E',45), ('F:F',26), ('G:I',15)]}
+       ,'Table6_Analysis':{'build':study_area_growth, 'keys':['Year'], 'multi_year':True
+                          ,'title':'Table 6 - Year-over-Year Change of the Study Area', 'title_cells':'A1:G1'
+                          ,'widths':[('A:A',5), ('B:G',15)]}
+       ,'Table7_Analysis':{'build':sector_growth, 'keys':['Marine Sector','Year'], 'multi_year':True
+                          ,'title':'Table 7 - Year-over-Year Change of the Marine Economy by Sector', 'title_cells':'A1:F1'
+                          ,'widths':[('A:A',25), ('B:B',5), ('C:F',15)]}
+       ,'TotalEconomy_Data':{}
+       ,'MarineSectors_Data':{}}
+
+"""# Employment Uncertainty
+
+The employment estimates count every establishment at the midpoint of its size class, so they can be off by a lot, especially for the large classes. In uncertainty mode, each employment column of Tables 1 to 5 gets four more columns:
+
+
+*   The lowest and highest employment possible, with every establishment at the bottom or at the top of its size class ('(min)' and '(max)')
+*   A confidence interval from a Monte Carlo simulation, where the number of employees of each establishment is equally likely to be anywhere in its size class ('(95% CI low)' and '(95% CI high)' at the default level)
+
+The simulation works on arrays rather than row by row. The employment of the establishments of a zip code, year and NAICS code is a sum of many independent draws, so it is drawn all at once from a normal distribution with the same mean and variance, kept between its lowest and highest employment. A batch of draws of every row is summed into the zip code totals and the marine industries of each zip code with np.bincount, the other tables are rolled up from those sums, and the percentiles of the sums give the intervals. The draws are centred on the middle of each size class range rather than on the midpoints, so for the 1,000 or more class the interval can sit above the estimate. The percent marine employment of each draw is taken from the marine and total employment of that same draw.
+"""
 
-"""# Write Outputs To Excel File
+def employment_ranges(TotalEcon, max_employees=Uncertainty_MaxEmployees, sizerange_df=sizerange_df):
+    """Return the establishments of each zip code, year and NAICS code of TotalEcon, with the lowest, highest and variance of their employment.
+
+    The number of employees of an establishment is taken as equally likely to be any whole number of
+    its size class, from Lowest to Highest in sizerange_df (`max_employees` for the open-ended class).
+    """
+    #Lowest and highest number of employees of each size class code, with NaN for the 'All Establishments' class and missing values
+    SizeClass=TotalEcon['Employment Size Class Code']
+    Ranges=sizerange_df.set_index('Employment Size Class Code')
+    Lowest=np.append(pd.to_numeric(Ranges['Lowest']).reindex(SizeClass.cat.categories).to_numpy(dtype=float), np.nan)
+    Highest=np.append(pd.to_numeric(Ranges['Highest']).fillna(max_employees).reindex(SizeClass.cat.categories).to_numpy(dtype=float), np.nan)
+    #Variance of a whole number drawn evenly from Lowest to Highest
+    Variance=((Highest - Lowest + 1)**2 - 1) / 12
+
+    Codes=SizeClass.cat.codes.to_numpy()
+    Establishments=TotalEcon['Establishments'].to_numpy()
+    Keys=['Zipcode','GeoName','Year','NAICS','Industry Name']
+    EconRanges=TotalEcon[Keys + ['Establishments']].assign(**{'Employment Min':Establishments * Lowest[Codes]
+                                                              ,'Employment Max':Establishments * Highest[Codes]
+                                                              ,'Employment Variance':Establishments * Variance[Codes]})
+    return grouping_sets(EconRanges, [Keys], values=('Establishments','Employment Min','Employment Max','Employment Variance'))[0]
+
+
+def simulate_sums(mean, sd, lowest, highest, groups, draws=Uncertainty_Draws, batch_cells=Uncertainty_BatchCells, seed=Uncertainty_Seed):
+    """Draw `draws` values of each row and return their sums by each grouping in `groups`.
+
+    Each row is drawn from a normal distribution with the given `mean` and `sd`, clipped between
+    `lowest` and `highest`. `groups` is a list of (group number of each row, number of groups)
+    pairs, with -1 for the rows left out of a grouping. Returns one float32 array of shape (number
+    of groups, draws) for each grouping. The rows are drawn about `batch_cells` values at a time, and the draws
+    of a seed are the same whatever the batch size.
+    """
+    rng=np.random.default_rng(seed)
+    Batch=max(1, min(draws, batch_cells // max(len(mean), 1)))
+    Rows=[np.flatnonzero(ids >= 0) for ids, _ in groups]
+    Sums=[np.empty((count, draws), dtype=np.float32) for _, count in groups]
+    for start in range(0, draws, Batch):
+        count=min(Batch, draws - start)
+        #One row of values per draw
+        Draws=rng.standard_normal((count, len(mean)), dtype=np.float32)
+        Draws*=sd
+        Draws+=mean
+        np.clip(Draws, lowest, highest, out=Draws)
+        for (ids, _), rows, sums in zip(groups, Rows, Sums):
+            #Number every (draw, group) pair, so one bincount adds up every draw of every group
+            Cells=(np.arange(count)[:, None] * len(sums) + ids[rows]).ravel()
+            Values=(Draws if len(rows) == len(ids) else Draws[:, rows]).ravel()
+            sums[:, start:start + count]=np.bincount(Cells, weights=Values, minlength=count * len(sums)).reshape(count, len(sums)).T
+    return Sums
+
+
+def add_uncertainty(tables, TotalEcon, marinesector_df=marinesector_df, max_employees=Uncertainty_MaxEmployees, draws=Uncertainty_Draws
+                    , level=Uncertainty_Level, batch_cells=Uncertainty_BatchCells, seed=Uncertainty_Seed, sizerange_df=sizerange_df, report=None):
+    """Add the lowest and highest employment, and a simulated `level`% confidence interval, to the employment columns of Tables 1 to 5.
+
+    `tables` are the analysis tables of TotalEcon, as returned by aggregate(). The tables are
+    replaced in `tables`, which is returned, and the ones missing from it are skipped, along with
+    the groupings only they need. Only the lowest and highest employment are added when `draws` is 0.
+    """
+    report=report if report is not None else RunReport()
+    if not any(name in tables for name in ['Table1_Analysis','Table2_Analysis','Table3_Analysis','Table4_Analysis','Table5_Analysis']):
+        return tables
+    #The groupings of the tables asked for. The simulated sums of most groupings are rolled up from a finer grouping, in the
+    #order of RollUps, so with draws the finer groupings are needed too
+    Needed={name for name in ['Table2_Analysis','Table3_Analysis','Table4_Analysis','Table5_Analysis'] if name in tables}
+    if 'Table1_Analysis' in tables:
+        Needed.update(['Zip Total','Study Area Total','Zip Marine','Study Area Marine'])
+    RollUps=[('Study Area Total','Zip Total'), ('Zip Marine','Table5_Analysis'), ('Study Area Marine','Table5_Analysis')
+            ,('Table4_Analysis','Table5_Analysis'), ('Table3_Analysis','Table5_Analysis'), ('Table2_Analysis','Table4_Analysis')]
+    if draws:
+        for name, finer in reversed(RollUps):
+            if name in Needed:
+                Needed.add(finer)
+    with report.stage('uncertainty: ranges', rows_in=len(TotalEcon)) as result:
+        EconRanges=employment_ranges(TotalEcon, max_employees, sizerange_df)
+        SectorCode, MarineSectorNames=marine_sector_codes(EconRanges['NAICS'], EconRanges['Year'], marinesector_df)
+        IsMarine=SectorCode >= 0
+        #Non-marine rows get a missing sector, so they are left out of the groupings by sector
+        EconRanges['Marine Sector']=pd.Categorical.from_codes(SectorCode, categories=MarineSectorNames)
+
+        #The group number of each row in each table. The marine totals of Table 1 are numbered like the total economy,
+        #so the percent marine employment of each group can be taken from the same draw
+        StudyArea=('XXXXX','Total for Study Area')
+        Groupings={'Zip Total':(['Zipcode','GeoName','Year'], False)
+                  ,'Study Area Total':(['Year'], False)
+                  ,'Zip Marine':(['Zipcode','GeoName','Year'], True)
+                  ,'Study Area Marine':(['Year'], True)
+                  ,'Table2_Analysis':(TABLES['Table2_Analysis']['keys'], True)
+                  ,'Table3_Analysis':(TABLES['Table3_Analysis']['keys'], True)
+                  ,'Table4_Analysis':(TABLES['Table4_Analysis']['keys'], True)
+                  ,'Table5_Analysis':(TABLES['Table5_Analysis']['keys'], True)}
+        Groupings={name: grouping for name, grouping in Groupings.items() if name in Needed}
+        GroupIds, Numbers, NumbersByKeys={}, {}, {}
+        for name, (keys, marine) in Groupings.items():
+            #The total and marine groupings of Table 1 share their group numbers
+            if tuple(keys) not in NumbersByKeys:
+                NumbersByKeys[tuple(keys)]=EconRanges.groupby(by=keys, observed=True, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+            Numbers[name]=NumbersByKeys[tuple(keys)]
+            GroupIds[name]=(np.where(IsMarine, Numbers[name], -1) if marine else Numbers[name], int(Numbers[name].max(initial=-1)) + 1)
+
+        def group_sums(name, column):
+            ids, count=GroupIds[name]
+            rows=ids >= 0
+            return np.bincount(ids[rows], weights=EconRanges[column].to_numpy(dtype=float)[rows], minlength=count)
+
+        def first_rows(name):
+            #The first row of each group
+            ids=GroupIds[name][0]
+            first=np.unique(ids, return_index=True)[1]
+            return first[ids[first] >= 0]
+
+        def group_keys(name):
+            return EconRanges[Groupings[name][0]].iloc[first_rows(name)].reset_index(drop=True)
+        result['rows_out']=len(EconRanges)
+
+    Low, High=(100 - level) / 2, 100 - (100 - level) / 2
+    LowLabel, HighLabel='(' + format(level, 'g') + '% CI low)', '(' + format(level, 'g') + '% CI high)'
+    if draws:
+        with report.stage('uncertainty: simulation', detail=str(draws) + ' draws', rows_in=len(EconRanges)) as result:
+            Lowest=EconRanges['Employment Min'].to_numpy(dtype=float)
+            Highest=EconRanges['Employment Max'].to_numpy(dtype=float)
+            #Only the zip code totals and the marine industries of each zip code are summed from the rows, the other groupings are
+            #rolled up from their sums like grouping_sets does
+            Finest=[name for name in ['Zip Total','Table5_Analysis'] if name in Needed]
+            Simulated=dict(zip(Finest, simulate_sums((Lowest + Highest) / 2, np.sqrt(EconRanges['Employment Variance'].to_numpy(dtype=float))
+                                                     , Lowest, Highest, [GroupIds[name] for name in Finest], draws, batch_cells, seed)))
+            for name, finer in RollUps:
+                if name not in Needed:
+                    continue
+                #The group of `name` each group of the finer grouping belongs to, then one bincount over every (group, draw) pair
+                Parents=Numbers[name][first_rows(finer)]
+                count=GroupIds[name][1]
+                Cells=(Parents[:, None] * draws + np.arange(draws)).ravel()
+                Simulated[name]=np.bincount(Cells, weights=Simulated[finer].ravel(), minlength=count * draws).reshape(count, draws)
+            result['rows_out']=sum(sums.size for sums in Simulated.values())
+
+    def columns(column, lowest, highest, sums, scale=1):
+        #The (min), (max) and confidence interval columns of `column`
+        values={column + ' (min)':lowest * scale, column + ' (max)':highest * scale}
+        if draws:
+            CI=np.percentile(sums, [Low, High], axis=1)
+            values.update({column + ' ' + LowLabel:CI[0] * scale, column + ' ' + HighLabel:CI[1] * scale})
+        return values
+
+    with report.stage('uncertainty: tables', rows_in=len(EconRanges)) as result:
+        Bounds={}
+        if 'Table1_Analysis' in tables:
+            #Table 1: the zip codes followed by the study area total, like the table itself
+            Table1=[]
+            for total, marine, study_area in [('Zip Total', 'Zip Marine', False), ('Study Area Total', 'Study Area Marine', True)]:
+                TotalMin, TotalMax=group_sums(total, 'Employment Min'), group_sums(total, 'Employment Max')
+                MarineMin, MarineMax=group_sums(marine, 'Employment Min'), group_sums(marine, 'Employment Max')
+                TotalSums, MarineSums=(Simulated[total], Simulated[marine]) if draws else (None, None)
+                Keys=group_keys(total)
+                if study_area:
+                    Keys=Keys.assign(Zipcode=StudyArea[0]).assign(GeoName=StudyArea[1])[['Zipcode','GeoName','Year']]
+                #The lowest share of marine employment has the marine industries at their lowest and the others at their highest, and the other way around
+                Table1.append(Keys.assign(**columns('Employment Estimate', TotalMin, TotalMax, TotalSums)
+                                          , **columns('Marine Employment', MarineMin, MarineMax, MarineSums)
+                                          , **columns('Percent Marine Employment', MarineMin / (TotalMax - MarineMax + MarineMin)
+                                                      , MarineMax / (TotalMin - MarineMin + MarineMax)
+                                                      , MarineSums / TotalSums if draws else None, scale=100)))
+            Bounds['Table1_Analysis']=pd.concat(Table1, ignore_index=True)
+
+        #Tables 2 to 5: the employment, and the average employment per establishment
+        for name in ['Table2_Analysis','Table3_Analysis','Table4_Analysis','Table5_Analysis']:
+            if name not in tables:
+                continue
+            EmploymentMin, EmploymentMax=group_sums(name, 'Employment Min'), group_sums(name, 'Employment Max')
+            Establishments=group_sums(name, 'Establishments')
+            Sums=Simulated[name] if draws else None
+            Bounds[name]=group_keys(name).assign(**columns('Employment Estimate', EmploymentMin, EmploymentMax, Sums)
+                                                 , **columns('Average Employment', EmploymentMin / Establishments, EmploymentMax / Establishments
+                                                             , Sums / Establishments[:, None] if draws else None))
+
+        for name, bounds in Bounds.items():
+            tables[name]=tables[name].merge(bounds.round(1), on=TABLES[name]['keys'], how='left')
+        result['rows_out']=sum(len(bounds) for bounds in Bounds.values())
+    return tables
+
+"""# Write Outputs
+
+Finally, we are going to take the analysis tables, the Total Economy dataframe and the Marine Economy dataframe and write them out. Each output format has its own writer function, listed in OUTPUT_WRITERS, which takes the tables by name and the output file path without an extension. The Excel writer puts each table into a separate tab of a formatted Excel file.
+"""
 
-Finally, we are going to take the Total Economy dataframe and the Marine Economy dataframe and write them out into separate tabs of an Excel file.
+#Excel worksheets hold at most 1,048,576 rows. Data tables longer than that are continued on extra sheets
+Excel_MaxRows=1048576
+
+def write_rows(worksheet, df, first_row=0, chunk_rows=Excel_ChunkRows, stats=None):
+    """Write the values of `df` to `worksheet` one row at a time in row order, starting at `first_row`.
+
+    The dataframe is converted to Python values `chunk_rows` rows at a time, so only one chunk is
+    ever held as Excel cells. Missing values are left as blank cells. When `stats` is a list, a
+    (sheet name, rows, seconds, peak RSS of the process in MB, MB the write raised that peak by)
+    record of the write is appended to it.
+    """
+    start_time=time.perf_counter()
+    peak_before=peak_rss_mb()
+    for start in range(0, len(df), chunk_rows):
+        chunk=df.iloc[start:start + chunk_rows]
+        columns=[chunk[column].astype(object).where(chunk[column].notna(), None).tolist() for column in chunk.columns]
+        for offset, row in enumerate(zip(*columns)):
+            worksheet.write_row(first_row + start + offset, 0, row)
+    if stats is not None:
+        peak=peak_rss_mb()
+        stats.append((worksheet.get_name(), len(df), time.perf_counter() - start_time, peak, None if peak is None else peak - peak_before))
+
+
+def write_data_sheets(workbook, sheet_name, df, stats=None):
+    """Write `df` with a header row to a new worksheet, continuing on sheets named `sheet_name`_2, _3, ... past the Excel row limit.
+
+    Returns the names of the worksheets written.
+    """
+    rows_per_sheet=Excel_MaxRows - 1
+    names=[]
+    for part, start in enumerate(range(0, max(len(df), 1), rows_per_sheet)):
+        name=sheet_name if part == 0 else sheet_name + '_' + str(part + 1)
+        worksheet=workbook.add_worksheet(name)
+        worksheet.write_row(0, 0, list(df.columns))
+        write_rows(worksheet, df.iloc[start:start + rows_per_sheet], first_row=1, stats=stats)
+        names.append(name)
+    return names
+
+
+#Formats of the analysis tabs. They are added to each workbook once and shared by all of its tabs
+Excel_Formats={'title':{'bold':1
+                       ,'border':1
+                       ,'align':'center'
+                       ,'valign':'vcenter'}
+              ,'header':{'bold':True
+                        ,'text_wrap':True
+                        ,'align':'center'
+                        ,'valign':'top'
+                        ,'border':1}
+              ,'table':{'text_wrap':True
+                       ,'align':'center'
+                       ,'valign':'vcenter'}}
+
+def write_excel(tables, out_file, report=None):
+    """Write the tables into the tabs of a formatted Excel file and return its path.
+
+    The tables are written in the order of TABLES, each with the layout declared there, and the
+    tables that aren't in TABLES are written to plain tabs after them. The write time of each
+    sheet, the peak memory of the process after it and how much the sheet raised that peak are
+    printed once the file is saved, and recorded in `report`.
+    """
+    report=report if report is not None else RunReport()
+    #Create the Excel file. In constant memory mode the rows of every sheet have to be written from top to bottom,
+    #so each analysis sheet gets its title, then its column headers, then its data.
+    workbook=xlsxwriter.Workbook(out_file + '.xlsx', {'constant_memory': Excel_ConstantMemory})
+    Formats={name: workbook.add_format(properties) for name, properties in Excel_Formats.items()}
+
+    #Write time and memory of each sheet, reported once the file is saved
+    SheetStats=[]
+
+    for name in [name for name in TABLES if name in tables] + [name for name in tables if name not in TABLES]:
+        layout=TABLES.get(name, {})
+        if 'title' not in layout:
+            #Stream the Total Economy and Marine Economy data into their own tabs
+            write_data_sheets(workbook, name, tables[name], stats=SheetStats)
+            continue
+
+        #Add the analysis table with its title. Set the column widths, merge the cells for the title block, then write the column headers and the table
+        worksheet=workbook.add_worksheet(name)
+        for columns, width in layout['widths']:
+            worksheet.set_column(columns, width, Formats['table'])
+        worksheet.merge_range(layout['title_cells'], layout['title'], Formats['title'])
+        worksheet.write_row(1, 0, list(tables[name].columns), Formats['header'])
+        write_rows(worksheet, tables[name], first_row=2, stats=SheetStats)
+
+    #Save the Excel file
+    start_time=time.perf_counter()
+    peak_before=peak_rss_mb()
+    workbook.close()
+    peak=peak_rss_mb()
+    SheetStats.append(('(saving the file)', None, time.perf_counter() - start_time, peak, None if peak is None else peak - peak_before))
+
+    #Report the write time and memory of each sheet. The peak is that of the whole process so far, so most sheets show the same
+    #peak, and the increase tells which sheets raised it
+    for sheet, rows, seconds, peak, increase in SheetStats:
+        record=report.add('write: excel', seconds, detail=sheet, rows_in=rows, rows_out=rows, peak_mb=peak)
+        record['peak_increase_mb']=None if increase is None else round(increase, 1)
+        print('  ' + sheet.ljust(22) + ('' if rows is None else str(rows) + ' rows, ') + str(round(seconds, 2)) + ' s'
+              + ('' if peak is None else ', process peak memory ' + str(round(peak)) + ' MB (+' + str(round(increase)) + ' MB)'))
+    return out_file + '.xlsx'
+
+
+def write_columnar(tables, out_file, output_format, report=None):
+    """Write each table to its own file in the folder `out_file` and return the folder.
+
+    `output_format` is 'parquet', 'feather' or 'csv'. CSV files are gzip compressed. The write of
+    each table is recorded in `report`.
+    """
+    report=report if report is not None else RunReport()
+    os.makedirs(out_file, exist_ok=True)
+    for name, df in tables.items():
+        with report.stage('write: ' + output_format, detail=name, rows_in=len(df)) as result:
+            path=os.path.join(out_file, name)
+            #Feather files can't store a dataframe index, and the index carries no information in any of the tables
+            df=df.reset_index(drop=True)
+            if output_format == 'parquet':
+                df.to_parquet(path + '.parquet', index=False)
+            elif output_format == 'feather':
+                df.to_feather(path + '.feather')
+            else:
+                df.to_csv(path + '.csv.gz', index=False, compression='gzip')
+            result['rows_out']=len(df)
+    return out_file
+
+
+#The writer function of each output format, called with the tables, the output path and the run report. A new format is added by adding its writer here
+OUTPUT_WRITERS={'excel':write_excel
+               ,'parquet':functools.partial(write_columnar, output_format='parquet')
+               ,'feather':functools.partial(write_columnar, output_format='feather')
+               ,'csv':functools.partial(write_columnar, output_format='csv')}
+
+def write(tables, out_file, formats=Output_Formats, report=None):
+    """Write the tables with the writer of each output format in `formats` and return the paths written.
+
+    `out_file` is the output path without a file extension. The writes are recorded in `report`.
+    """
+    unknown=[output_format for output_format in formats if output_format not in OUTPUT_WRITERS]
+    if unknown:
+        raise ValueError('Unknown output format: ' + ', '.join(unknown) + '. Choose from ' + ', '.join(OUTPUT_WRITERS))
+    os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+    paths=[]
+    for output_format in formats:
+        paths.append(OUTPUT_WRITERS[output_format](tables, out_file, report=report))
+        print('Written ' + output_format + ' output: ' + paths[-1])
+    return paths
+
+"""# Incremental Runs
+
+Study areas are usually revised a few zip codes at a time. To avoid processing the same zip codes again, the cleaned rows (TotalEcon) and the zip code, year and industry totals (EconByIndustry) of each zip code and year are saved to a PartialStore. On the next run only the zip codes that aren't in the store are fetched and processed, and the study area tables are rolled up again from the saved totals of every zip code, which give exactly the same tables as processing them all together. The saved results are kept in a folder named after a fingerprint of the midpoints, the marine sector crosswalk and the data source, so changing any of them starts from scratch.
 """
-print('Creating the output file')
-
-import pandas.io.formats.excel
-pandas.io.formats.excel.header_style = None
-#Create the Excel file
-writer = pd.ExcelWriter(OutFile, 
-                        engine ='xlsxwriter')
-
-
-#Take the data frames and write them into separate tabs. Horizontal layout of analysis tab.
-TotalMarineCompare_df.to_excel(writer, sheet_name='Table1_Analysis', startrow=1, startcol=0,index=False)
-MarineSectorsAnalysis_df.to_excel(writer, sheet_name='Table2_Analysis', startrow=1, startcol=0,index=False)
-MarineIndustriesAnalysis_df.to_excel(writer, sheet_name='Table3_Analysis', startrow=1, startcol=0,index=False)
-MarineSectorsZipAnalysis_df.to_excel(writer, sheet_name='Table4_Analysis', startrow=1, startcol=0,index=False)
-MarineIndustriesZipAnalysis_df.to_excel(writer, sheet_name='Table5_Analysis', startrow=1, startcol=0,index=False)
-TotalEcon.to_excel(writer, sheet_name='TotalEconomy_Data', startrow=0, startcol=0,index=False)
-Marine_df.to_excel(writer, sheet_name='MarineSectors_Data', startrow=0, startcol=0,index=False)
-
-#############################################################################
-#Add titles to the analysis tables
-workbook  = writer.book
-worksheet = writer.sheets['Table1_Analysis']
-title1='Table 1 - Comparison of Total Economy and Marine Economy'
-
-#Format the title text
-title_format1=workbook.add_format({'bold' : 1
-                                  ,'border' : 1
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-header_format1=workbook.add_format({ 
-                                'bold': True, 
-                                'text_wrap': True,
-                                'align': 'center',
-                                'valign': 'top', 
-                                'border': 1}) 
-
-table_format1=workbook.add_format({'text_wrap': True
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-
-#Set column widths for analysis table 1    
-worksheet.set_column('A:A',8,table_format1)
-worksheet.set_column('B:B',20,table_format1)
-worksheet.set_column('C:C',5,table_format1)
-worksheet.set_column('D:H',15,table_format1)
-
-
-for columnnum, columnname in enumerate(list(TotalMarineCompare_df.columns)):
-    worksheet.write(1, columnnum, columnname, header_format1)
-    
-#Merge the cells for the title blocks
-worksheet.merge_range('A1:H1',title1,title_format1)
-
-#############################################################################
-
-workbook  = writer.book
-worksheet = writer.sheets['Table2_Analysis']
-title2='Table 2 - Marine Economy by Sector'
-
-
-#Format the title text
-title_format2=workbook.add_format({'bold' : 1
-                                  ,'border' : 1
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-header_format2=workbook.add_format({ 
-                                'bold': True, 
-                                'text_wrap': True,
-                                'align': 'center',
-                                'valign': 'top', 
-                                'border': 1}) 
-
-table_format2=workbook.add_format({'text_wrap': True
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-#Set column widths for analysis table 2
-worksheet.set_column('A:A',5,table_format2)
-worksheet.set_column('B:B',25,table_format2)
-worksheet.set_column('C:E',15,table_format2)
-
-for columnnum, columnname in enumerate(list(MarineSectorsAnalysis_df.columns)):
-    worksheet.write(1, columnnum, columnname, header_format2)
-
-worksheet.merge_range('A1:E1',title2,title_format2)
-
-#############################################################################
-
-workbook  = writer.book
-worksheet = writer.sheets['Table3_Analysis']
-title3='Marine Economy by Industry'
-
-
-#Format the title text
-title_format3=workbook.add_format({'bold' : 1
-                                  ,'border' : 1
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-header_format3=workbook.add_format({ 
-                                'bold': True, 
-                                'text_wrap': True,
-                                'align': 'center',
-                                'valign': 'top', 
-                                'border': 1}) 
-
-table_format3=workbook.add_format({'text_wrap': True
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-#Set column widths for analysis table 3    
-worksheet.set_column('A:A',5,table_format3)
-worksheet.set_column('B:B',7,table_format3)
-worksheet.set_column('C:C',45,table_format3)
-worksheet.set_column('D:D',26,table_format3)
-worksheet.set_column('E:G',15,table_format3)
-
-for columnnum, columnname in enumerate(list(MarineIndustriesAnalysis_df.columns)):
-    worksheet.write(1, columnnum, columnname, header_format3)
-
-worksheet.merge_range('A1:G1',title3,title_format3)
-
-
-#############################################################################
-
-workbook  = writer.book
-worksheet = writer.sheets['Table4_Analysis']
-title4='Marine Economy by Zip Code by Sector'
-
-
-#Format the title text
-title_format4=workbook.add_format({'bold' : 1
-                                  ,'border' : 1
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-header_format4=workbook.add_format({ 
-                                'bold': True, 
-                                'text_wrap': True,
-                                'align': 'center',
-                                'valign': 'top', 
-                                'border': 1}) 
-
-table_format4=workbook.add_format({'text_wrap': True
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-#Set column widths for analysis table 4
-worksheet.set_column('A:A',8,table_format4)
-worksheet.set_column('B:B',25,table_format4)
-worksheet.set_column('C:C',5,table_format4)
-worksheet.set_column('D:D',26,table_format4)
-worksheet.set_column('E:G',15,table_format4)
-
-for columnnum, columnname in enumerate(list(MarineSectorsZipAnalysis_df.columns)):
-    worksheet.write(1, columnnum, columnname, header_format4)
-    
-worksheet.merge_range('A1:G1',title4,title_format4)
-
-#############################################################################
-
-workbook  = writer.book
-worksheet = writer.sheets['Table5_Analysis']
-title5='Marine Economy by Zip Code by Industry'
-
-
-#Format the title text
-title_format5=workbook.add_format({'bold' : 1
-                                  ,'border' : 1
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-table_format5=workbook.add_format({'text_wrap': True
-                                  ,'align': 'center'
-                                  ,'valign': 'vcenter'})
-
-header_format5=workbook.add_format({ 
-                                'bold': True, 
-                                'text_wrap': True,
-                                'align': 'center',
-                                'valign': 'top', 
-                                'border': 1}) 
 
+#Columns stored as categoricals with the categories of each zip code only
+Partial_Categoricals=['Zipcode','GeoName','Year','NAICS','Industry Name','Employment Size Class']
+
+class PartialStore:
+    """On-disk store of the TotalEcon rows and EconByIndustry totals of each zip code and year, one pickle file per pair."""
+
+    def __init__(self, directory, midpoint_df=midpoint_df, marinesector_df=marinesector_df, source='api'):
+        #The pickled dataframes can only be read back by the same pandas version, and `source` tells apart data read from different places
+        fingerprint=hashlib.sha1((midpoint_df.to_csv(index=False) + marinesector_df.to_csv(index=False) + pd.__version__ + source).encode()).hexdigest()[:12]
+        self.directory=os.path.join(directory, fingerprint)
+
+    def _path(self, year, zipcode):
+        return os.path.join(self.directory, str(year), str(zipcode) + '.pkl')
+
+    def get(self, year, zipcode):
+        """Return the saved (TotalEcon, EconByIndustry) of a zip code and year, (None, None) when it has no data, or None when it isn't saved."""
+        try:
+            with open(self._path(year, zipcode), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            #A missing, truncated or incompatible file (unpickling can raise almost anything) is processed again
+            return None
+
+    def put(self, year, zipcode, part):
+        """Save the (TotalEcon, EconByIndustry) of a zip code and year."""
+        with _atomic_write(self._path(year, zipcode), open, 'wb') as f:
+            pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def invalidate(self, year=None):
+        """Delete the saved results, either all of them or only those for one year. Returns the number deleted."""
+        removed=0
+        for folder, _, names in os.walk(self.directory):
+            if year is not None and os.path.basename(folder) != str(year):
+                continue
+            for name in names:
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(folder, name))
+                    removed+=1
+        return removed
+
+
+def split_by_zip(df):
+    """Return the rows of `df` by zip code, with the categories of each zip code only."""
+    parts={}
+    for zipcode, rows in df.groupby(by='Zipcode', observed=True, sort=False):
+        parts[zipcode]=rows.assign(**{column: rows[column].cat.remove_unused_categories() for column in Partial_Categoricals if column in rows.columns})
+    return parts
+
+
+def combine_parts(parts):
+    """Concatenate the results of several zip codes, merging the categories of each categorical column.
+
+    The merged categories are sorted like those of a column converted with astype('category'), so
+    the tables rolled up from the result come out in the same order as in a full run.
+    """
+    columns={}
+    for column in parts[0].columns:
+        if isinstance(parts[0][column].dtype, pd.CategoricalDtype):
+            columns[column]=pd.api.types.union_categoricals([part[column] for part in parts], sort_categories=True)
+        else:
+            columns[column]=np.concatenate([part[column].to_numpy() for part in parts])
+    return pd.DataFrame(columns)
+
+
+def process_zips(zips, years, partials, load, report=None):
+    """Return the TotalEcon rows and EconByIndustry totals of a study area, processing only the zip codes not in `partials`.
+
+    `load(zips, years)` returns the df_AllZips of the zip codes and years that have to be
+    processed. Their results are saved to `partials` one zip code and year at a time.
+    """
+    report=report if report is not None else RunReport()
+    years=parse_years(years)
+    parts={}
+    for year in years:
+        for zipcode in zips:
+            part=partials.get(year, zipcode)
+            if part is not None:
+                parts[year, zipcode]=part
+    missing=[(year, zipcode) for year in years for zipcode in zips if (year, zipcode) not in parts]
+    print('Reusing the results of ' + str(len(parts)) + ' zip code and year pairs, processing ' + str(len(missing)))
+
+    for year in sorted({year for year, _ in missing}):
+        year_zips=[zipcode for each_year, zipcode in missing if each_year == year]
+        try:
+            TotalEcon=enrich(clean(load(year_zips, [year]), report=report), report=report)[0]
+        except NoDataError:
+            #None of the zip codes have data for the year. Any other error is raised, so nothing is saved for zip codes that failed
+            TotalEcon=None
+        if TotalEcon is not None:
+            EconByIndustry=grouping_sets(TotalEcon, [['Zipcode','GeoName','Year','NAICS','Industry Name']])[0]
+            TotalEconByZip=split_by_zip(TotalEcon)
+            EconByIndustryByZip=split_by_zip(EconByIndustry)
+        for zipcode in year_zips:
+            if TotalEcon is not None and zipcode in TotalEconByZip:
+                part=(TotalEconByZip[zipcode], EconByIndustryByZip[zipcode])
+            else:
+                part=(None, None)
+            partials.put(year, zipcode, part)
+            parts[year, zipcode]=part
+
+    with report.stage('combine zip code results', rows_in=len(parts)) as result:
+        found=[parts[year, zipcode] for year in years for zipcode in zips if parts[year, zipcode][0] is not None]
+        if not found:
+            raise NoDataError('There is no data for any of the requested zip codes in ' + ', '.join(years))
+        TotalEcon=combine_parts([TotalEcon for TotalEcon, _ in found])
+        EconByIndustry=combine_parts([EconByIndustry for _, EconByIndustry in found])
+        result['rows_out']=len(TotalEcon)
+    return TotalEcon, EconByIndustry
+
+
+"""# Running the Pipeline
+
+run() chains the steps above together for one study area. It returns the tables by name, in the order of the Excel tabs: the analysis tables, then 'TotalEconomy_Data' (TotalEcon) and 'MarineSectors_Data' (Marine_df).
+"""
 
-#Set column widths for analysis table 5
-worksheet.set_column('A:A',8,table_format5)
-worksheet.set_column('B:AB',20,table_format5)
-worksheet.set_column('C:C',5,table_format5)
-worksheet.set_column('D:D',7,table_format5)
-worksheet.set_column('E:E',45,table_format5)
-worksheet.set_column('F:F',26,table_format5)
-worksheet.set_column('G:I',15,table_format5)
-
-for columnnum, columnname in enumerate(list(MarineIndustriesZipAnalysis_df.columns)):
-    worksheet.write(1, columnnum, columnname, header_format5)
-    
-worksheet.merge_range('A1:I1',title5,title_format5)
-#############################################################################
-
-#Save the Excel file
-writer.save()
-
-print('Your file is ready!')
-EndTime = datetime.datetime.now()
-print('Ended at ' + EndTime.strftime("%I:%M:%S %p"))
+def run(zips, years, out_file=None, formats=Output_Formats, cache=None, report=None, detail_files=None, naics_titles=None,
+        partials=None, uncertainty=None, names=None, **kwargs):
+    """Run the whole pipeline for a list of zip codes and one or more years, and return the output tables by name.
+
+    `years` is anything parse_years accepts. The data is read from `detail_files` (ZBP detail
+    files, with the NAICS titles in `naics_titles`) when they are given, and from the Census API
+    otherwise. When `partials` is a PartialStore, only the zip codes it doesn't hold yet are
+    processed. When `uncertainty` is a dict of add_uncertainty keyword arguments (an empty dict for
+    the defaults), the employment ranges and confidence intervals are added to Tables 1 to 5. Only
+    the tables in `names` (any of the TABLES) are created and written when it is given. The
+    outputs are written when `out_file` (the output path without a file extension) is given. The stages of the run are recorded in `report` when one is given. Any extra keyword
+    arguments are passed on to fetch_all_zips.
+    """
+    def load(zips, years):
+        if detail_files:
+            print('Reading zip code data from the ZBP detail files')
+            return read_detail_files(zips, years, detail_files, naics_titles, report=report)
+        print('Accessing zip code data from the Census API')
+        return fetch(zips, parse_years(years), cache=cache, report=report, **kwargs)
+
+    if partials is not None:
+        TotalEcon, EconByIndustry=process_zips(zips, years, partials, load, report=report)
+        Marine_df=add_marine_sector(TotalEcon)
+
+        print('Creating analysis tables')
+        tables=analysis_tables(EconByIndustry, report=report, names=names)
+    else:
+        df_AllZips=load(zips, years)
+
+        print ('All zip codes have been accessed, creating Total Economy table')
+        TotalEcon, Marine_df=enrich(clean(df_AllZips, report=report), report=report)
+
+        print('Creating analysis tables')
+        tables=aggregate(TotalEcon, report=report, names=names)
+    if uncertainty is not None:
+        print('Estimating the range of the employment estimates')
+        tables=add_uncertainty(tables, TotalEcon, report=report, **uncertainty)
+    for name, df in [('TotalEconomy_Data', TotalEcon), ('MarineSectors_Data', Marine_df)]:
+        if names is None or name in names:
+            tables[name]=df
+
+    if out_file is not None:
+        print('Creating the output files')
+        write(tables, out_file, formats, report=report)
+    return tables
+
+
+def main(argv=None):
+    """Command line entry point. Every argument defaults to the inputs set at the top of this file."""
+    parser=argparse.ArgumentParser(description='Download Census Zip Code Business Patterns data for a list of zip codes '
+                                               'and estimate their total and marine economy.')
+    parser.add_argument('-z', '--zips', nargs='+', default=list(zip_list), help='zip codes of the study area')
+    parser.add_argument('-y', '--years', nargs='+', help='years of data, such as 2016 or 2012-2016 (default: the years of the '
+                                                       'detail files when they are given, DataYear otherwise)')
+    parser.add_argument('-o', '--out-dir', default=OutFile_Loc, help='folder where the output is saved')
+    parser.add_argument('-p', '--prefix', default=OutFile_NamePrefix, help="output file name prefix, followed by '" + OutFile_BaseName + "'")
+    parser.add_argument('-f', '--formats', nargs='+', default=Output_Formats, choices=sorted(OUTPUT_WRITERS), help='output formats to write')
+    parser.add_argument('--cache-dir', help='folder of cached Census API responses (default: ' + str(Cache_Dir) + ' in the output folder)')
+    parser.add_argument('--no-cache', action='store_true', help='always download from the Census API')
+    parser.add_argument('--invalidate-cache', action='store_true', default=Cache_Invalidate,
+                        help='delete the cached responses for the requested years before running')
+    parser.add_argument('--partials-dir', help='folder of saved zip code results, reused by later runs (default: ' + str(Partials_Dir)
+                                               + ' in the output folder)')
+    parser.add_argument('--no-partials', action='store_true', help='process every zip code, without reusing or saving zip code results')
+    parser.add_argument('--census-url', default=Census_BaseURL, help='base url of the Census API')
+    parser.add_argument('--workers', type=int, default=Fetch_MaxWorkers, help='number of API requests sent at the same time')
+    parser.add_argument('--zips-per-request', type=int, default=Fetch_ZipsPerRequest, help='number of zip codes packed into one API request')
+    parser.add_argument('--detail-files', nargs='+', default=Detail_Files, metavar='PATH',
+                        help='read the data from these ZBP detail files (zbpYYdetail.txt or .zip) instead of the Census API')
+    parser.add_argument('--naics-titles', default=Detail_NAICSTitles, metavar='PATH', help='NAICS titles file used with --detail-files')
+    parser.add_argument('-t', '--tables', nargs='+', choices=list(TABLES), metavar='TABLE',
+                        help='only create and write these tables (default: all of them): ' + ', '.join(TABLES))
+    parser.add_argument('--uncertainty', action='store_true', default=Uncertainty,
+                        help='add the lowest and highest employment, and a simulated confidence interval, to Tables 1 to 5')
+    parser.add_argument('--draws', type=int, default=Uncertainty_Draws, help='number of simulated draws with --uncertainty (0 for no simulation)')
+    parser.add_argument('--confidence', type=float, default=Uncertainty_Level, help='confidence level of the intervals in percent')
+    parser.add_argument('--max-employees', type=int, default=Uncertainty_MaxEmployees, help='highest number of employees of the 1,000 or more class')
+    parser.add_argument('--report', metavar='PATH', help='save the time, rows and peak memory of each stage as a JSON run report')
+    parser.add_argument('--profile', metavar='PATH', help='save a cProfile dump of the run (the API requests run in other threads and are not included)')
+    args=parser.parse_args(argv)
+
+    StartTime = datetime.datetime.now()
+    print('Starting at ' + StartTime.strftime("%I:%M:%S %p"))
+
+    if args.years is not None:
+        years=parse_years(args.years)
+    else:
+        years=sorted(detail_file_year(path) for path in args.detail_files) if args.detail_files else parse_years(DataYear)
+    OutFile=os.path.join(args.out_dir, args.prefix + OutFile_BaseName)
+    print('Output file: ' + OutFile + ' (' + ', '.join(args.formats) + ')')
+
+    CacheDir=args.cache_dir if args.cache_dir is not None else output_folder(args.out_dir, Cache_Dir)
+    if CacheDir is not None and not args.no_cache and not args.detail_files:
+        ApiCache=ZBPCache(CacheDir, max_bytes=Cache_MaxMB * 1024 * 1024, base_url=args.census_url)
+        if args.invalidate_cache:
+            for year in years:
+                print('Removed ' + str(ApiCache.invalidate(year=year)) + ' cached responses for ' + year)
+    else:
+        ApiCache=None
+
+    PartialsDir=args.partials_dir if args.partials_dir is not None else output_folder(args.out_dir, Partials_Dir)
+    if PartialsDir is not None and not args.no_partials:
+        #Results read from detail files are kept apart from those fetched from the API, since their industry names can differ, and
+        #results fetched from another server (such as the synthetic stand-in) are kept apart from those of the Census API
+        Source='api:' + args.census_url if not args.detail_files else ','.join(os.path.basename(path) for path in args.detail_files) + ';' + str(args.naics_titles)
+        Partials=PartialStore(PartialsDir, source=Source)
+        if args.invalidate_cache:
+            for year in years:
+                print('Removed ' + str(Partials.invalidate(year=year)) + ' saved zip code results for ' + year)
+    else:
+        Partials=None
+
+    Report=RunReport()
+    Profiler=cProfile.Profile() if args.profile else None
+    if Profiler is not None:
+        Profiler.enable()
+    run(args.zips, years, out_file=OutFile, formats=args.formats, cache=ApiCache, report=Report,
+        detail_files=args.detail_files, naics_titles=args.naics_titles, partials=Partials,
+        uncertainty={'draws':args.draws, 'level':args.confidence, 'max_employees':args.max_employees} if args.uncertainty else None,
+        names=args.tables, base_url=args.census_url, max_workers=args.workers, zips_per_request=args.zips_per_request)
+    if Profiler is not None:
+        Profiler.disable()
+        Profiler.dump_stats(args.profile)
+        print('Profile saved to ' + args.profile)
+
+    print('Your files are ready!')
+    #Total time of each kind of stage, slowest first
+    for stage, total in sorted(Report.to_dict()['totals'].items(), key=lambda item: -item[1]['seconds']):
+        print('  ' + stage.ljust(32) + str(round(total['seconds'], 2)) + ' s')
+    if args.report:
+        print('Run report saved to ' + Report.save(args.report))
+    if ApiCache is not None:
+        print(ApiCache.summary())
+    EndTime = datetime.datetime.now()
+    print('Ended at ' + EndTime.strftime("%I:%M:%S %p"))
+
+
+if __name__ == '__main__':
+    main()